@@ -2,6 +2,9 @@ from flask import Flask
 from flask_socketio import SocketIO
 from flask_cors import CORS
 from .models import db
+from .schema import upgrade_schema
+from .message_queue import message_queue_options, DEFAULT_CHANNEL
+from .metrics import metrics, log_profile
 import os
 
 socketio = SocketIO(cors_allowed_origins="*")
@@ -19,21 +22,144 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    # In-memory board cache limits (boards, idle seconds, approximate bytes)
+    app.config['BOARD_CACHE_MAX_BOARDS'] = int(os.environ.get('BOARD_CACHE_MAX_BOARDS', 1000))
+    app.config['BOARD_CACHE_TTL'] = int(os.environ.get('BOARD_CACHE_TTL', 3600))
+    app.config['BOARD_CACHE_MAX_BYTES'] = int(os.environ.get('BOARD_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+    # Plies between position snapshots used to rebuild boards (0 disables them)
+    app.config['SNAPSHOT_INTERVAL'] = int(os.environ.get('SNAPSHOT_INTERVAL', 20))
+
+    # sync commits every move before broadcasting it; write-behind journals
+    # moves locally and commits them to the database in batches
+    app.config['PERSISTENCE_MODE'] = os.environ.get('PERSISTENCE_MODE', 'sync')
+    app.config['JOURNAL_PATH'] = os.environ.get('JOURNAL_PATH')  # Defaults to instance/journal
+    app.config['JOURNAL_FSYNC'] = os.environ.get('JOURNAL_FSYNC', 'always')  # always, interval or off
+    app.config['WRITE_BEHIND_INTERVAL'] = float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.05))
+    app.config['WRITE_BEHIND_MAX_BATCH'] = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 500))
+    app.config['WRITE_BEHIND_MAX_PENDING'] = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 10000))
+
+    # Message queue that relays room broadcasts between workers; leave unset
+    # for a single process, use local:// for an in-process stand-in
+    app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    app.config['SOCKETIO_CHANNEL'] = os.environ.get('SOCKETIO_CHANNEL', DEFAULT_CHANNEL)
+
+    # Matchmaking search window (rating points), widening and queue expiry (seconds)
+    app.config['MATCHMAKING_BASE_WINDOW'] = int(os.environ.get('MATCHMAKING_BASE_WINDOW', 100))
+    app.config['MATCHMAKING_WIDEN_PER_SECOND'] = float(os.environ.get('MATCHMAKING_WIDEN_PER_SECOND', 10))
+    app.config['MATCHMAKING_MAX_WINDOW'] = int(os.environ.get('MATCHMAKING_MAX_WINDOW', 800))
+    app.config['MATCHMAKING_ENTRY_TTL'] = int(os.environ.get('MATCHMAKING_ENTRY_TTL', 300))
+    app.config['MATCHMAKING_SWEEP_INTERVAL'] = float(os.environ.get('MATCHMAKING_SWEEP_INTERVAL', 2))
+
+    # Seconds between coalesced position updates sent to spectators (0 sends every move)
+    app.config['SPECTATOR_FLUSH_INTERVAL'] = float(os.environ.get('SPECTATOR_FLUSH_INTERVAL', 0.5))
+
+    # Seconds between checks of the game clocks for flag falls
+    app.config['CLOCK_TICK_INTERVAL'] = float(os.environ.get('CLOCK_TICK_INTERVAL', 0.1))
+
+    # Processes hashing and checking passwords (default: one per CPU, 0 hashes
+    # inline), and the most hashes queued before logins get a 503
+    app.config['AUTH_HASH_WORKERS'] = int(os.environ['AUTH_HASH_WORKERS']) if os.environ.get('AUTH_HASH_WORKERS') else None
+    app.config['AUTH_HASH_MAX_PENDING'] = int(os.environ.get('AUTH_HASH_MAX_PENDING', 64))
+
+    # User identities cached per worker, and seconds before they are read again
+    app.config['USER_CACHE_MAX_SIZE'] = int(os.environ.get('USER_CACHE_MAX_SIZE', 10000))
+    app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+
+    # Seconds between background passes that add finished games to the
+    # opening explorer (0 disables them), games per pass, and plies indexed
+    # per game (changing it needs a rebuild-explorer)
+    app.config['EXPLORER_INDEX_INTERVAL'] = float(os.environ.get('EXPLORER_INDEX_INTERVAL', 5))
+    app.config['EXPLORER_BATCH_SIZE'] = int(os.environ.get('EXPLORER_BATCH_SIZE', 50))
+    app.config['EXPLORER_MAX_PLY'] = int(os.environ.get('EXPLORER_MAX_PLY', 40))
+
+    # Seconds between background passes that move finished games to the
+    # compressed archive (0 disables them), days a finished game stays live
+    # first, and games moved per transaction
+    app.config['ARCHIVE_INTERVAL'] = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+    app.config['ARCHIVE_AFTER_DAYS'] = float(os.environ.get('ARCHIVE_AFTER_DAYS', 30))
+    app.config['ARCHIVE_BATCH_SIZE'] = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))
+
+    # Seconds between passes of the tournament director, which recounts
+    # scores and pairs the next swiss round or idle arena players
+    app.config['TOURNAMENT_TICK_INTERVAL'] = float(os.environ.get('TOURNAMENT_TICK_INTERVAL', 2))
+
+    # Engine processes searching computer moves (default: one per CPU), the
+    # most searches in flight before new bot games are refused, and the
+    # longest a computer move may take in seconds
+    app.config['ENGINE_WORKERS'] = int(os.environ['ENGINE_WORKERS']) if os.environ.get('ENGINE_WORKERS') else None
+    app.config['ENGINE_MAX_PENDING'] = int(os.environ.get('ENGINE_MAX_PENDING', 1000))
+    app.config['ENGINE_MAX_MOVE_TIME'] = float(os.environ.get('ENGINE_MAX_MOVE_TIME', 2.0))
+
+    # Fraction of timed sections recorded in latency histograms, and of
+    # socket events profiled with cProfile and logged
+    app.config['METRICS_SAMPLE_RATE'] = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+    app.config['METRICS_PROFILE_RATE'] = float(os.environ.get('METRICS_PROFILE_RATE', 0.0))
+
+    # Initialize instrumentation
+    metrics.init_app(app)
+    if app.config['METRICS_PROFILE_RATE']:
+        metrics.add_profile_hook(log_profile)
+
     # Initialize database
     db.init_app(app)
 
     with app.app_context():
         db.create_all()  # Create tables if they don't exist
+        upgrade_schema(db)  # Add new columns to tables that already exist
+
+    from .auth import password_hasher, user_cache
+    password_hasher.init_app(app)
+    user_cache.init_app(app)
 
     # Register routes
     from .routes import main
     app.register_blueprint(main)
 
+    # Register CLI commands
+    from .cli import register_commands
+    register_commands(app)
+
     # Initialize SocketIO
-    socketio.init_app(app)
+    socketio.init_app(app, **message_queue_options(
+        app.config['SOCKETIO_MESSAGE_QUEUE'], app.config['SOCKETIO_CHANNEL']))
 
     # Register SocketIO events
-    from .sockets import register_sockets
+    from .sockets import register_sockets, board_cache, clock_scheduler, bot_player
     register_sockets(socketio)
+    board_cache.init_app(app)
+
+    # Moves journaled before a restart reach the database before anything reads it
+    from .persistence import move_store
+    move_store.init_app(app)
+    with app.app_context():
+        move_store.replay()
+
+    # Clocks of games that were running before a restart are armed again
+    clock_scheduler.init_app(app)
+    with app.app_context():
+        clock_scheduler.rearm()
+
+    from .spectators import spectator_feed
+    spectator_feed.init_app(app)
+
+    # Computer players exist before any bot game can be created
+    bot_player.init_app(app)
+    with app.app_context():
+        bot_player.load_bots()
+
+    from .matchmaking import matchmaker
+    matchmaker.init_app(app)
+
+    from .explorer import explorer_indexer
+    explorer_indexer.init_app(app)
+
+    from .archive import game_archiver
+    game_archiver.init_app(app)
+
+    # Tournaments that were running before a restart carry on from the
+    # first request this worker serves
+    from .tournaments import tournament_director
+    tournament_director.init_app(app)
 
     return app
\ No newline at end of file
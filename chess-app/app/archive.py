@@ -0,0 +1,160 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.orm import joinedload
+
+from . import socketio
+from .metrics import metrics
+from .models import db, ArchivedGame, Game, GameMove, GameSnapshot, archive_month, pack_moves, unpack_moves
+from .pgn import batch_moves
+
+logger = logging.getLogger(__name__)
+
+# Columns copied from games into archived_games as they are
+ARCHIVED_FIELDS = ('id', 'player_white_id', 'player_black_id', 'result', 'time_control',
+                   'white_clock_ms', 'black_clock_ms', 'tournament_id', 'round', 'created_at', 'updated_at')
+
+ARCHIVED_GAMES = metrics.counter('chess_archived_games_total', 'Finished games moved to the archive')
+
+
+def load_archived_game(game_id):
+    """Return an archived game with both players loaded, or None"""
+    return ArchivedGame.query.options(
+        joinedload(ArchivedGame.white_player), joinedload(ArchivedGame.black_player)
+    ).filter(ArchivedGame.id == game_id).first()
+
+
+def create_partitions(months):
+    """Create the archived_games partitions of the given months, on PostgreSQL only"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for month in sorted(months):
+        db.session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS archived_games_{int(month)} '
+            f'PARTITION OF archived_games FOR VALUES IN ({int(month)})'
+        ))
+
+
+def archive_batch(cutoff, limit, after_id=0):
+    """Move up to limit finished games that ended before cutoff into the archive.
+
+    Only games the opening explorer has counted are moved, and only those
+    with an id above after_id, so a pass can walk the table once. Their
+    moves and snapshot rows are deleted with them; the games row is deleted
+    with RETURNING, so of two workers archiving the same game only the one
+    whose delete finds it writes the archived copy. Returns (archived, last
+    id looked at), with a last id of None once nothing is left.
+    """
+    candidates = db.session.execute(
+        select(Game.id, Game.moves, Game.ply_count).where(
+            Game.status == 'finished', Game.explored.is_(True),
+            Game.updated_at < cutoff, Game.id > after_id
+        ).order_by(Game.id).limit(limit)
+    ).all()
+    if not candidates:
+        return 0, None
+
+    moves = batch_moves([row.id for row in candidates if row.ply_count])
+    packed = {}
+    for row in candidates:
+        uci_moves = moves.get(row.id, []) if row.ply_count else (row.moves or '').split()
+        try:
+            packed[row.id] = (pack_moves(uci_moves), len(uci_moves))
+        except ValueError as e:
+            logger.warning("Not archiving game %s: %s", row.id, e)
+
+    game_ids = list(packed)
+    db.session.execute(delete(GameSnapshot).where(GameSnapshot.game_id.in_(game_ids)))
+    db.session.execute(delete(GameMove).where(GameMove.game_id.in_(game_ids)))
+    deleted = db.session.execute(
+        delete(Game).where(Game.id.in_(game_ids), Game.status == 'finished')
+        .returning(*(getattr(Game, field) for field in ARCHIVED_FIELDS))
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    rows = []
+    for row in deleted:
+        blob, ply_count = packed[row.id]
+        ended = row.updated_at or row.created_at or datetime.utcnow()
+        rows.append(dict(row._mapping, archive_month=archive_month(ended), ply_count=ply_count,
+                         packed_moves=blob, archived_at=datetime.utcnow()))
+    if rows:
+        create_partitions({row['archive_month'] for row in rows})
+        db.session.execute(insert(ArchivedGame), rows)
+    db.session.commit()
+    ARCHIVED_GAMES.inc(len(rows))
+    return len(rows), candidates[-1].id
+
+
+def iter_archived_games(batch_size=2000):
+    """Yield lists of (UCI moves, result) of archived games, batch_size games at a time"""
+    after_id = None
+    while True:
+        query = select(ArchivedGame.id, ArchivedGame.packed_moves, ArchivedGame.result)
+        if after_id is not None:
+            query = query.where(ArchivedGame.id > after_id)
+        rows = db.session.execute(query.order_by(ArchivedGame.id).limit(batch_size)).all()
+        if not rows:
+            return
+        yield [(unpack_moves(row.packed_moves), row.result) for row in rows]
+        after_id = rows[-1].id
+
+
+class GameArchiver:
+    """Background task moving finished games from games into archived_games.
+
+    Every ``interval`` seconds it archives, ``batch_size`` at a time, the
+    finished games that ended more than ``after_days`` days ago and have
+    been counted by the opening explorer. The live games table then holds
+    little more than games in progress, and an archived game takes a few
+    bytes per move instead of a row. Reads of a game fall back to the
+    archive, so the game page, sockets, history and PGN export see archived
+    games as before. Like the explorer, the task starts with the first game
+    that finishes in this worker.
+    """
+
+    def __init__(self, interval=3600.0, after_days=30, batch_size=500):
+        self.interval = interval
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.app = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        """Read archiving settings from the app config"""
+        self.app = app
+        self.interval = app.config.get('ARCHIVE_INTERVAL', self.interval)
+        self.after_days = app.config.get('ARCHIVE_AFTER_DAYS', self.after_days)
+        self.batch_size = app.config.get('ARCHIVE_BATCH_SIZE', self.batch_size)
+
+    def start(self):
+        """Start the background task, once; called whenever a game finishes"""
+        with self._lock:
+            if self._task is None and self.app is not None and self.interval:
+                self._task = socketio.start_background_task(self._run_archiver)
+
+    def archive_pending(self, now=None):
+        """Archive every game that is due, returning how many were archived"""
+        cutoff = (now or datetime.utcnow()) - timedelta(days=self.after_days)
+        archived, after_id = 0, 0
+        while after_id is not None:
+            count, after_id = archive_batch(cutoff, self.batch_size, after_id)
+            archived += count
+            socketio.sleep(0)
+        return archived
+
+    def _run_archiver(self):
+        while True:
+            socketio.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.archive_pending()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Error archiving finished games")
+
+
+game_archiver = GameArchiver()
@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from . import socketio
+from .metrics import metrics
+from .models import db, User
+
+logger = logging.getLogger(__name__)
+
+HASH_SECONDS = metrics.histogram('chess_password_hash_seconds', 'Time spent waiting for password hashes and checks')
+HASHES_REFUSED = metrics.counter('chess_password_hashes_refused_total', 'Logins and signups refused while the hash pool was full')
+
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already queued"""
+
+
+def _pool_context():
+    # Same reasoning as the engine pool: forked workers do not re-run the entry script
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+class PasswordHasher:
+    """Runs password hashing and checks in a process pool, off the hub.
+
+    PBKDF2 and scrypt are slow on purpose; run inline they would stall every
+    socket of the worker during a burst of logins. The caller waits by
+    polling with ``socketio.sleep``, so other greenthreads keep running. At
+    most ``max_pending`` hashes are queued or running; beyond that
+    ``HasherBusy`` is raised so the route can answer 503 instead of building
+    an unbounded backlog. With ``workers`` set to 0 hashing runs inline.
+    """
+
+    def __init__(self, workers=None, max_pending=64, poll=0.005):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.poll = poll
+        self._pool = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read pool settings from the app config"""
+        self.workers = app.config.get('AUTH_HASH_WORKERS', self.workers)
+        self.max_pending = app.config.get('AUTH_HASH_MAX_PENDING', self.max_pending)
+
+    def hash(self, password):
+        """Return a salted hash of the password"""
+        return self._run(generate_password_hash, password)
+
+    def check(self, pwhash, password):
+        """Return True if the password matches the stored hash"""
+        return self._run(check_password_hash, pwhash, password)
+
+    def _run(self, f, *args):
+        if self.workers == 0:
+            return f(*args)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                HASHES_REFUSED.inc()
+                raise HasherBusy()
+            self._pending += 1
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers or os.cpu_count() or 1,
+                                                 mp_context=_pool_context())
+            pool = self._pool
+        try:
+            with metrics.timed(HASH_SECONDS):
+                future = pool.submit(f, *args)
+                while not future.done():
+                    socketio.sleep(self.poll)
+                return future.result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def shutdown(self):
+        """Stop the hashing processes"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def __len__(self):
+        with self._lock:
+            return self._pending
+
+
+# What the app needs to know about a user outside of authentication
+Identity = namedtuple('Identity', 'id username email rating bot_level')
+
+
+class UserCache:
+    """LRU/TTL cache of user identities, keyed by user id.
+
+    Pages and socket handlers look up the same users over and over; this
+    answers them from memory. Entries expire after ``ttl`` seconds and the
+    least recently used are evicted beyond ``max_size``. ORM updates and
+    deletes of a user invalidate its entry when they commit, through the
+    session events below; bulk Core updates of users must call
+    ``invalidate`` themselves. Other workers see a change once their entry
+    expires.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        """Read cache limits from the app config"""
+        self.max_size = app.config.get('USER_CACHE_MAX_SIZE', self.max_size)
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+
+    def get(self, user_id):
+        """Return the user's Identity, loading it on a miss, or None if there is no such user"""
+        if user_id is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        row = db.session.query(
+            User.id, User.username, User.email, User.rating, User.bot_level
+        ).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        identity = Identity(*row)
+        if self.max_size:
+            with self._lock:
+                self._entries[user_id] = (identity, now + self.ttl)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return identity
+
+    def username(self, user_id, default=None):
+        """Return the user's name, or default if there is no such user"""
+        identity = self.get(user_id)
+        return identity.username if identity else default
+
+    def invalidate(self, user_id):
+        """Forget a user so the next lookup reads the database"""
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Return the cache size and lookup counters"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
+
+
+password_hasher = PasswordHasher()
+user_cache = UserCache()
+metrics.callback('chess_user_cache_events_total', 'User identity cache lookups and invalidations',
+                 lambda: {event: user_cache.stats()[event] for event in ('hits', 'misses', 'invalidations')},
+                 type='counter', label='event')
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    # Drop the entry now, and again on commit in case a reader cached the
+    # old row while the transaction was open
+    user_cache.invalidate(target.id)
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_rolled_back_users(session, previous_transaction):
+    session.info.pop('changed_users', None)
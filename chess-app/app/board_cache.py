@@ -0,0 +1,276 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .metrics import metrics
+from .positions import PositionTracker
+
+# Rough in-memory footprint of a chess.Board and of each move on its stack,
+# used to keep the cache under its memory budget without walking objects
+BOARD_BASE_BYTES = 2048
+BOARD_MOVE_BYTES = 256
+
+REBUILD_SECONDS = metrics.histogram('chess_board_rebuild_seconds', 'Time spent rebuilding evicted or missing boards')
+
+
+def estimate_board_size(board):
+    """Approximate number of bytes held by a board and its move stack"""
+    return BOARD_BASE_BYTES + len(board.move_stack) * BOARD_MOVE_BYTES
+
+
+class BoardEntry:
+    """A cached board together with data derived from its current position"""
+    __slots__ = ('board', 'last_access', 'size', 'legal_ply', 'legal_moves', 'tracker')
+
+    def __init__(self, board):
+        self.board = board
+        self.last_access = time.monotonic()
+        self.size = estimate_board_size(board)
+        self.legal_ply = None
+        self.legal_moves = None
+        self.tracker = None
+
+
+class BoardCache:
+    """LRU/TTL cache of boards for active games, keyed by room.
+
+    Boards are evicted when idle for longer than the TTL, when there are more
+    than ``max_boards`` of them, or when their estimated size exceeds
+    ``max_bytes``. An evicted board is rebuilt from the database on the next
+    access through ``loader(game)``. The cache also tracks which sockets are in which room, with a
+    reverse index so disconnect cleanup only touches that socket's rooms.
+    """
+
+    def __init__(self, loader, max_boards=1000, ttl=3600, max_bytes=64 * 1024 * 1024):
+        self.loader = loader
+        self.max_boards = max_boards
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._room_sids = {}
+        self._sid_rooms = {}
+        self._room_locks = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        """Read cache limits from the app config"""
+        self.max_boards = app.config.get('BOARD_CACHE_MAX_BOARDS', self.max_boards)
+        self.ttl = app.config.get('BOARD_CACHE_TTL', self.ttl)
+        self.max_bytes = app.config.get('BOARD_CACHE_MAX_BYTES', self.max_bytes)
+
+    # Boards
+
+    def get(self, room, game=None):
+        """Return the board for a room, rebuilding it from ``game`` on a miss.
+
+        Returns None on a miss when no game is given. Raises ValueError if the
+        stored moves cannot be replayed.
+        """
+        with self._lock:
+            entry = self._entries.get(room)
+            if entry and self._expired(entry, time.monotonic()):
+                self._remove(room)
+                self.evictions += 1
+                entry = None
+            if entry:
+                self.hits += 1
+                self._touch(room, entry)
+                return entry.board
+            self.misses += 1
+
+        if game is None:
+            return None
+        with metrics.timed(REBUILD_SECONDS):
+            board = self.loader(game)
+        self.put(room, board)
+        return board
+
+    def put(self, room, board):
+        """Store a board for a room and evict whatever no longer fits"""
+        with self._lock:
+            if room in self._entries:
+                self._remove(room)
+            entry = BoardEntry(board)
+            self._entries[room] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def touch(self, room):
+        """Mark a room's board as used and refresh its size after a move"""
+        with self._lock:
+            entry = self._entries.get(room)
+            if entry:
+                self._touch(room, entry)
+                size = estimate_board_size(entry.board)
+                self._bytes += size - entry.size
+                entry.size = size
+                self._evict()
+
+    def discard(self, room):
+        """Drop a room's board from the cache"""
+        with self._lock:
+            self._remove(room)
+
+    def legal_moves(self, room, board):
+        """Return the legal moves for the board's position, generated at most once per ply"""
+        ply = board.ply()
+        with self._lock:
+            entry = self._entries.get(room)
+            if entry and entry.board is board and entry.legal_ply == ply:
+                return entry.legal_moves
+        moves = [move.uci() for move in board.legal_moves]
+        with self._lock:
+            entry = self._entries.get(room)
+            if entry and entry.board is board:
+                entry.legal_ply = ply
+                entry.legal_moves = moves
+        return moves
+
+    def tracker(self, room, board):
+        """Return the position tracker for the board's current ply.
+
+        A tracker one ply behind is advanced with the move just pushed;
+        otherwise one is built from the board, which only replays the moves
+        since the last pawn move or capture.
+        """
+        with self._lock:
+            entry = self._entries.get(room)
+            tracker = entry.tracker if entry and entry.board is board else None
+        ply = board.ply()
+        if tracker is not None and tracker.ply == ply - 1:
+            tracker.push(board)
+        elif tracker is None or tracker.ply != ply:
+            tracker = PositionTracker(board)
+            with self._lock:
+                entry = self._entries.get(room)
+                if entry and entry.board is board:
+                    entry.tracker = tracker
+        return tracker
+
+    def sweep(self):
+        """Evict every board that has been idle for longer than the TTL"""
+        with self._lock:
+            now = time.monotonic()
+            for room in [room for room, entry in self._entries.items() if self._expired(entry, now)]:
+                self._remove(room)
+                self.evictions += 1
+
+    def _touch(self, room, entry):
+        entry.last_access = time.monotonic()
+        self._entries.move_to_end(room)
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now - entry.last_access > self.ttl
+
+    def _remove(self, room):
+        entry = self._entries.pop(room, None)
+        if entry:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        now = time.monotonic()
+        # Oldest entries sit at the front of the OrderedDict
+        while self._entries:
+            room, entry = next(iter(self._entries.items()))
+            over_budget = len(self._entries) > self.max_boards or self._bytes > self.max_bytes
+            if not over_budget and not self._expired(entry, now):
+                break
+            self._remove(room)
+            self.evictions += 1
+
+    # Per-room serialization
+
+    @contextmanager
+    def locked(self, room, sleep=time.sleep):
+        """Hold a room's lock, yielding with ``sleep`` while another task has it.
+
+        Each room gets its own lock, created on first use and dropped once no
+        task holds or waits for it, so unrelated games never contend.
+        """
+        with self._lock:
+            holder = self._room_locks.setdefault(room, [threading.Lock(), 0])
+            holder[1] += 1
+        try:
+            while not holder[0].acquire(blocking=False):
+                sleep(0.001)
+            try:
+                yield
+            finally:
+                holder[0].release()
+        finally:
+            with self._lock:
+                holder[1] -= 1
+                if not holder[1]:
+                    del self._room_locks[room]
+
+    # Room membership
+
+    def add_sid(self, room, sid):
+        """Record that a socket joined a room"""
+        with self._lock:
+            self._room_sids.setdefault(room, set()).add(sid)
+            self._sid_rooms.setdefault(sid, set()).add(room)
+
+    def remove_sid(self, room, sid):
+        """Record that a socket left a room, returning True if the room is now empty"""
+        with self._lock:
+            rooms = self._sid_rooms.get(sid)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self._sid_rooms[sid]
+            sids = self._room_sids.get(room)
+            if sids is None:
+                return False
+            sids.discard(sid)
+            if sids:
+                return False
+            del self._room_sids[room]
+            return True
+
+    def drop_sid(self, sid):
+        """Remove a disconnected socket from all of its rooms"""
+        with self._lock:
+            for room in self._sid_rooms.pop(sid, set()):
+                sids = self._room_sids.get(room)
+                if sids is not None:
+                    sids.discard(sid)
+                    if not sids:
+                        del self._room_sids[room]
+        self.sweep()
+
+    def room_sids(self, room):
+        """Return the sockets currently in a room"""
+        with self._lock:
+            return set(self._room_sids.get(room, ()))
+
+    # Introspection
+
+    def __contains__(self, room):
+        with self._lock:
+            return room in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Return cache counters and current usage"""
+        with self._lock:
+            return {
+                'boards': len(self._entries),
+                'bytes': self._bytes,
+                'max_boards': self.max_boards,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'rooms': len(self._room_sids),
+                'sids': len(self._sid_rooms),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
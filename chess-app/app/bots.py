@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from . import socketio
+from .clocks import parse_time_control, remaining_ms
+from .engine import LEVELS, choose_move
+from .metrics import metrics
+from .models import db, User
+from .snapshots import snapshot_fields
+
+logger = logging.getLogger(__name__)
+
+BOT_EMAIL_DOMAIN = 'bots.invalid'
+UNUSABLE_PASSWORD = '!'  # Never matches, so nobody can log in as a computer player
+
+# Share of the clock a timed move may use: remaining / MOVES_TO_GO plus most of the increment
+MOVES_TO_GO = 30
+MIN_MOVE_SECONDS = 0.05
+
+SEARCH_SECONDS = metrics.histogram('chess_engine_search_seconds', 'Time from requesting a computer move to receiving it')
+
+
+def _pool_context():
+    # Forked workers start without importing the app again; spawned ones
+    # would re-run the entry script, and with it create_app()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+class BotPlayer:
+    """Plays the computer's side of bot games with searches in a process pool.
+
+    Each level of LEVELS has one computer player, a user with that
+    ``bot_level``. A search is requested when a bot game reaches the
+    computer's turn and runs in one of ``workers`` engine processes, so the
+    eventlet hub never runs the CPU-bound search itself. One background
+    task polls the finished searches every ``poll`` seconds and hands the
+    moves to ``on_move(bot_id, game_id, move_uci)``, which plays them like
+    any other move. At most one search per game is in flight, and no more
+    than ``max_pending`` in total; ``busy()`` tells callers to stop
+    starting new bot games.
+    """
+
+    def __init__(self, on_move, workers=None, max_pending=1000, max_move_time=2.0, poll=0.02):
+        self.on_move = on_move
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_move_time = max_move_time
+        self.poll = poll
+        self.app = None
+        self._pool = None
+        self._pending = {}
+        self._levels = {}
+        self._lock = threading.Lock()
+        self._poller = None
+        self.searches = 0
+        self.failures = 0
+
+    def init_app(self, app):
+        """Read engine settings from the app config"""
+        self.app = app
+        self.workers = app.config.get('ENGINE_WORKERS', self.workers)
+        self.max_pending = app.config.get('ENGINE_MAX_PENDING', self.max_pending)
+        self.max_move_time = app.config.get('ENGINE_MAX_MOVE_TIME', self.max_move_time)
+
+    def load_bots(self):
+        """Create the computer players of every level and cache their ids.
+
+        Runs at startup, so every worker knows all bots before the first
+        bot game is created anywhere.
+        """
+        levels = dict(db.session.query(User.bot_level, User.id).filter(User.bot_level.isnot(None)).all())
+        missing = [level for level in LEVELS if level not in levels]
+        if missing:
+            db.session.add_all([User(
+                username=f'Computer (level {level})',
+                email=f'level-{level}@{BOT_EMAIL_DOMAIN}',
+                password_hash=UNUSABLE_PASSWORD,
+                bot_level=level
+            ) for level in missing])
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker created them first
+                db.session.rollback()
+            levels = dict(db.session.query(User.bot_level, User.id).filter(User.bot_level.isnot(None)).all())
+        with self._lock:
+            self._levels = {user_id: level for level, user_id in levels.items()}
+
+    def bot_id(self, level):
+        """Return the user id of the computer player of the given level"""
+        with self._lock:
+            for user_id, bot_level in self._levels.items():
+                if bot_level == level:
+                    return user_id
+        return None
+
+    def level_of(self, user_id):
+        """Return the level of a computer player, or None for people"""
+        with self._lock:
+            return self._levels.get(user_id)
+
+    def busy(self):
+        """Return True if no more searches should be queued"""
+        with self._lock:
+            return len(self._pending) >= self.max_pending
+
+    def request(self, game, board):
+        """Start a search if the computer is to move in the game.
+
+        Returns True if a search was queued.
+        """
+        if game.status != 'active':
+            return False
+        bot_id = game.player_white_id if board.turn else game.player_black_id
+        level = self.level_of(bot_id)
+        if level is None:
+            return False
+        with self._lock:
+            if game.id in self._pending:
+                return False
+            fen, history = snapshot_fields(board)
+            future = self._executor().submit(choose_move, fen, history, level, self._budget(game, board))
+            self._pending[game.id] = (future, bot_id, time.monotonic())
+            if self._poller is None and self.app is not None and self.poll:
+                self._poller = socketio.start_background_task(self._run_poller)
+        return True
+
+    def _budget(self, game, board):
+        """Seconds the computer may think, within its clock in timed games"""
+        seconds = self.max_move_time
+        clocks = remaining_ms(game, datetime.utcnow())
+        if clocks:
+            left = clocks['white' if board.turn else 'black']
+            increment = parse_time_control(game.time_control)[1]
+            seconds = min(seconds, (left / MOVES_TO_GO + increment * 0.8) / 1000)
+        return max(seconds, MIN_MOVE_SECONDS)
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers or os.cpu_count() or 1,
+                                             mp_context=_pool_context())
+        return self._pool
+
+    def ready(self):
+        """Pop and return (game_id, bot_id, move) for every finished search"""
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            done = [game_id for game_id, (future, _, _) in self._pending.items() if future.done()]
+            for game_id in done:
+                future, bot_id, started = self._pending.pop(game_id)
+                SEARCH_SECONDS.observe(now - started)
+                try:
+                    result.append((game_id, bot_id, future.result()))
+                    self.searches += 1
+                except Exception:
+                    self.failures += 1
+                    logger.exception("Engine search failed in game %s", game_id)
+        return result
+
+    def play_ready(self):
+        """Play every finished search's move, returning how many were played"""
+        moves = self.ready()
+        for game_id, bot_id, move_uci in moves:
+            try:
+                self.on_move(bot_id, game_id, move_uci)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Error playing the computer's move in game %s", game_id)
+        return len(moves)
+
+    def _run_poller(self):
+        while True:
+            socketio.sleep(self.poll)
+            if not self._pending:
+                continue
+            with self.app.app_context():
+                self.play_ready()
+
+    def shutdown(self):
+        """Stop the engine processes"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self):
+        """Return the number of searches in flight, finished and failed"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'workers': self.workers or os.cpu_count() or 1,
+                'searches': self.searches,
+                'failures': self.failures
+            }
+
+
+def valid_level(level):
+    """Return True if level is one of the engine's strength settings"""
+    return isinstance(level, int) and not isinstance(level, bool) and level in LEVELS
@@ -0,0 +1,83 @@
+import click
+from .models import db, User, Game
+from .archive import game_archiver
+from .explorer import rebuild_index
+from .pgn import export_games, import_pgn
+from .routes import GAME_STATUSES
+
+
+def register_commands(app):
+    """Register maintenance commands with the flask CLI"""
+
+    @app.cli.command('migrate-moves')
+    @click.option('--batch-size', default=500, help='Games to migrate per commit.')
+    def migrate_moves(batch_size):
+        """Copy legacy Game.moves strings into the game_moves table"""
+        migrated = 0
+        while True:
+            games = Game.query.filter(
+                Game.moves.isnot(None), Game.moves != ''
+            ).order_by(Game.id).limit(batch_size).all()
+            if not games:
+                break
+            for game in games:
+                game.migrate_legacy_moves()
+            db.session.commit()
+            migrated += len(games)
+            click.echo(f"Migrated {migrated} games")
+        click.echo(f"Done, {migrated} games migrated")
+
+    @app.cli.command('export-pgn')
+    @click.argument('output', type=click.File('w'), default='-')
+    @click.option('--user', 'username', help='Only export games of this user.')
+    @click.option('--status', 'statuses', multiple=True, type=click.Choice(sorted(GAME_STATUSES)),
+                  help='Only export games with this status; repeatable.')
+    @click.option('--batch-size', default=500, help='Games read per database round trip.')
+    def export_pgn(output, username, statuses, batch_size):
+        """Stream games as PGN to OUTPUT (stdout by default)"""
+        user_id = None
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                raise click.ClickException(f"No user named {username}")
+            user_id = user.id
+        exported = 0
+        for pgn in export_games(user_id, statuses, batch_size):
+            output.write(pgn)
+            exported += 1
+        click.echo(f"Exported {exported} games", err=True)
+
+    @app.cli.command('import-pgn')
+    @click.argument('source', type=click.File('r'))
+    @click.option('--workers', type=int, help='Parser processes (default: one per CPU).')
+    @click.option('--chunk-size', default=200, help='Games parsed and inserted per batch.')
+    def import_pgn_command(source, workers, chunk_size):
+        """Bulk import finished games from a PGN file ('-' for stdin)"""
+        def progress(imported, skipped):
+            click.echo(f"Imported {imported} games, skipped {skipped}", err=True)
+
+        imported, skipped = import_pgn(source, workers, chunk_size, progress=progress)
+        click.echo(f"Done, {imported} games imported, {skipped} skipped")
+
+    @app.cli.command('rebuild-explorer')
+    @click.option('--workers', type=int, help='Replay processes (default: one per CPU).')
+    @click.option('--batch-size', default=2000, help='Games counted per commit.')
+    def rebuild_explorer(workers, batch_size):
+        """Recount the opening explorer from every finished game"""
+        def progress(indexed):
+            click.echo(f"Indexed {indexed} games", err=True)
+
+        indexed = rebuild_index(workers, batch_size, app.config['EXPLORER_MAX_PLY'], progress=progress)
+        click.echo(f"Done, {indexed} games indexed")
+
+    @app.cli.command('archive-games')
+    @click.option('--after-days', type=float, help='Archive games finished this many days ago (default: ARCHIVE_AFTER_DAYS).')
+    @click.option('--batch-size', type=int, help='Games moved per commit (default: ARCHIVE_BATCH_SIZE).')
+    def archive_games(after_days, batch_size):
+        """Move finished games into the compressed archive now"""
+        if after_days is not None:
+            game_archiver.after_days = after_days
+        if batch_size:
+            game_archiver.batch_size = batch_size
+        archived = game_archiver.archive_pending()
+        click.echo(f"Done, {archived} games archived")
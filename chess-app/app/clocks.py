@@ -0,0 +1,225 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+import chess
+
+from . import socketio
+from .models import db, Game, GameMove
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_time_control(time_control):
+    """Return (base, increment) in milliseconds for a '5+3' time control, or None if untimed"""
+    if not time_control:
+        return None
+    minutes, increment = time_control.split('+')
+    return int(minutes) * 60000, int(increment) * 1000
+
+
+def _elapsed_ms(start, end):
+    return int((end - start).total_seconds() * 1000)
+
+
+def _timestamp(dt):
+    return (dt - EPOCH).total_seconds()
+
+
+def side_to_move(game):
+    return 'white' if game.ply_count % 2 == 0 else 'black'
+
+
+def start_clocks(game, now):
+    """Give both players the full base time, with white's clock running from now"""
+    control = parse_time_control(game.time_control)
+    if control is None:
+        return
+    game.white_clock_ms = game.black_clock_ms = control[0]
+    game.clock_started_at = now
+
+
+def remaining_ms(game, now):
+    """Return each player's time left at now, or None for untimed games.
+
+    Stored clocks hold the time left when the last move was made; the side
+    to move loses the time elapsed since ``clock_started_at`` while the game
+    is active.
+    """
+    if not game.time_control or game.white_clock_ms is None:
+        return None
+    clocks = {'white': game.white_clock_ms, 'black': game.black_clock_ms}
+    if game.status == 'active' and game.clock_started_at:
+        color = side_to_move(game)
+        clocks[color] = max(0, clocks[color] - _elapsed_ms(game.clock_started_at, now))
+    return clocks
+
+
+def apply_move(game, color, now):
+    """Charge the mover's clock and add the increment.
+
+    Returns False, leaving the clocks untouched, if the mover's flag fell
+    before the move was made.
+    """
+    control = parse_time_control(game.time_control)
+    if control is None or game.white_clock_ms is None:
+        return True
+    left = getattr(game, f'{color}_clock_ms') - _elapsed_ms(game.clock_started_at, now)
+    if left <= 0:
+        return False
+    setattr(game, f'{color}_clock_ms', left + control[1])
+    game.clock_started_at = now
+    return True
+
+
+def stop_clocks(game, now):
+    """Charge the side to move for its time so far, for games that end between moves"""
+    clocks = remaining_ms(game, now)
+    if clocks is None:
+        return
+    game.white_clock_ms = clocks['white']
+    game.black_clock_ms = clocks['black']
+    game.clock_started_at = now
+
+
+def flag(game, board):
+    """End the game on time for the side to move.
+
+    The opponent wins unless they cannot possibly checkmate, in which case
+    the game is drawn.
+    """
+    color = side_to_move(game)
+    setattr(game, f'{color}_clock_ms', 0)
+    game.status = 'finished'
+    if board.has_insufficient_material(chess.BLACK if color == 'white' else chess.WHITE):
+        game.result = '1/2-1/2'
+    else:
+        game.result = '0-1' if color == 'white' else '1-0'
+
+
+def deadline(game):
+    """Return the Unix time at which the side to move runs out of time, or None"""
+    if game.status != 'active' or not game.time_control or game.white_clock_ms is None:
+        return None
+    left = getattr(game, f'{side_to_move(game)}_clock_ms')
+    return _timestamp(game.clock_started_at) + left / 1000
+
+
+def reconstruct_clocks(game):
+    """Recompute the stored clocks from the game's start and move timestamps"""
+    control = parse_time_control(game.time_control)
+    if control is None:
+        return
+    base, increment = control
+    clocks = {'white': base, 'black': base}
+    previous = game.created_at
+    timestamps = db.session.query(GameMove.created_at).filter(
+        GameMove.game_id == game.id
+    ).order_by(GameMove.ply)
+    for ply, (played_at,) in enumerate(timestamps, start=1):
+        color = 'white' if ply % 2 else 'black'
+        clocks[color] -= _elapsed_ms(previous, played_at)
+        clocks[color] += increment
+        previous = played_at
+    game.white_clock_ms = clocks['white']
+    game.black_clock_ms = clocks['black']
+    game.clock_started_at = previous
+
+
+class ClockScheduler:
+    """Single min-heap of flag-fall deadlines for every timed game.
+
+    One background task wakes every ``tick`` seconds and hands due games to
+    ``on_flag(game_id, ply)``, so thousands of clocks cost one task and an
+    O(log n) push per move instead of a timer per game. Entries are
+    replaced lazily: arming a game again supersedes its older entry, which
+    is skipped when popped. ``on_flag`` must re-check the game, since a move
+    made on another worker is not visible here.
+    """
+
+    def __init__(self, on_flag, tick=0.1, compact_slack=1024):
+        self.on_flag = on_flag
+        self.tick = tick
+        self.compact_slack = compact_slack
+        self.app = None
+        self._heap = []
+        self._armed = {}
+        self._lock = threading.Lock()
+        self._ticker = None
+
+    def init_app(self, app):
+        """Read the tick interval from the app config"""
+        self.app = app
+        self.tick = app.config.get('CLOCK_TICK_INTERVAL', self.tick)
+
+    def arm(self, game):
+        """Schedule the flag check for the game's side to move, replacing any earlier one"""
+        when = deadline(game)
+        if when is None:
+            self.cancel(game.id)
+            return
+        with self._lock:
+            self._armed[game.id] = (when, game.ply_count)
+            heapq.heappush(self._heap, (when, game.id, game.ply_count))
+            if len(self._heap) > 2 * len(self._armed) + self.compact_slack:
+                # Drop superseded entries rather than waiting for them to come due
+                self._heap = [(w, game_id, ply) for game_id, (w, ply) in self._armed.items()]
+                heapq.heapify(self._heap)
+            if self._ticker is None and self.app is not None and self.tick:
+                self._ticker = socketio.start_background_task(self._run_ticker)
+
+    def cancel(self, game_id):
+        """Forget a game's deadline, for example once it has finished"""
+        with self._lock:
+            self._armed.pop(game_id, None)
+
+    def due(self, now=None):
+        """Pop and return (game_id, ply) for every armed deadline that has passed"""
+        now = time.time() if now is None else now
+        result = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, game_id, ply = heapq.heappop(self._heap)
+                if self._armed.get(game_id) == (when, ply):
+                    del self._armed[game_id]
+                    result.append((game_id, ply))
+        return result
+
+    def rearm(self):
+        """Arm every active timed game, for example after a worker restart"""
+        games = Game.query.filter(Game.status == 'active', Game.time_control.isnot(None))
+        for game in games.all():
+            if game.white_clock_ms is None or game.clock_started_at is None:
+                reconstruct_clocks(game)
+            self.arm(game)
+        db.session.commit()
+
+    def _run_ticker(self):
+        while True:
+            socketio.sleep(self.tick)
+            expired = self.due()
+            if not expired:
+                continue
+            with self.app.app_context():
+                for game_id, ply in expired:
+                    try:
+                        self.on_flag(game_id, ply)
+                    except Exception:
+                        db.session.rollback()
+                        logger.exception("Error checking the clock of game %s", game_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._armed)
+
+    def stats(self):
+        """Return the number of armed clocks and queued heap entries"""
+        with self._lock:
+            return {
+                'armed': len(self._armed),
+                'heap': len(self._heap)
+            }
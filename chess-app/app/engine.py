@@ -0,0 +1,266 @@
+import random
+import time
+from collections import namedtuple
+
+import chess
+import chess.polyglot
+
+# Strength settings: deepest iteration, seconds per move and the chance of
+# playing a random legal move instead of searching
+Level = namedtuple('Level', 'depth seconds blunder')
+LEVELS = {
+    1: Level(1, 0.1, 0.3),
+    2: Level(2, 0.25, 0.15),
+    3: Level(3, 0.5, 0.05),
+    4: Level(4, 1.0, 0.0),
+    5: Level(64, 2.0, 0.0),
+}
+DEFAULT_LEVEL = 3
+
+MATE = 100000
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# Transposition table entries kept per worker process before it is cleared
+TABLE_MAX_ENTRIES = 500000
+
+# Check the clock every this many nodes
+NODES_PER_CLOCK_CHECK = 1024
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+
+# Piece-square tables from white's point of view, rank 8 first
+PIECE_SQUARES = {
+    chess.PAWN: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ),
+    chess.KNIGHT: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ),
+    chess.BISHOP: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ),
+    chess.ROOK: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ),
+    chess.QUEEN: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ),
+    chess.KING: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ),
+}
+
+# Positions searched by this process, keyed by Zobrist hash. It outlives a
+# single search, so the next move of a game starts from what the last found
+_table = {}
+
+
+def evaluate(board):
+    """Score the position in centipawns from the side to move's point of view"""
+    score = 0
+    for piece_type, value in PIECE_VALUES.items():
+        squares = PIECE_SQUARES[piece_type]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.WHITE)):
+            score += value + squares[square ^ 56]
+        for square in chess.scan_forward(board.pieces_mask(piece_type, chess.BLACK)):
+            score -= value + squares[square]
+    return score if board.turn == chess.WHITE else -score
+
+
+def _capture_order(board, move):
+    """MVV-LVA: take the most valuable victim with the least valuable attacker"""
+    victim = board.piece_type_at(move.to_square) or chess.PAWN  # en passant
+    return PIECE_VALUES[victim] * 10 - PIECE_VALUES[board.piece_type_at(move.from_square)]
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search once its time budget is spent"""
+
+
+class Searcher:
+    """Alpha-beta search with iterative deepening and a transposition table.
+
+    Each iteration searches one ply deeper, starting with the best move of
+    the previous one, until ``max_depth`` is reached or the deadline
+    passes; the result of the last completed iteration is played. Leaves
+    are extended with a captures-only quiescence search.
+    """
+
+    def __init__(self, board, deadline, table=None):
+        self.board = board
+        self.deadline = deadline
+        self.table = _table if table is None else table
+        self.nodes = 0
+        self.depth = 0
+        self.best_move = None
+
+    def search(self, max_depth):
+        """Return the best move found within the depth and time budget"""
+        best = None
+        for depth in range(1, max_depth + 1):
+            try:
+                score = self.negamax(depth, -MATE, MATE, 0)
+            except SearchTimeout:
+                break
+            best, self.depth = self.best_move, depth
+            if abs(score) >= MATE - depth:
+                break  # Forced mate found, searching deeper cannot improve it
+        return best
+
+    def _tick(self):
+        self.nodes += 1
+        if self.nodes % NODES_PER_CLOCK_CHECK == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def _ordered(self, moves, first=None):
+        def order(move):
+            if move == first:
+                return -MATE
+            if self.board.is_capture(move):
+                return -_capture_order(self.board, move)
+            return -PIECE_VALUES[move.promotion] if move.promotion else 0
+        return sorted(moves, key=order)
+
+    def negamax(self, depth, alpha, beta, ply):
+        self._tick()
+        board = self.board
+        if ply and (board.halfmove_clock >= 100 or board.is_repetition(2)):
+            return 0
+        if depth <= 0:
+            return self.quiesce(alpha, beta)
+
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self.table.get(key)
+        hash_move = None
+        if entry is not None:
+            entry_depth, bound, score, hash_move = entry
+            if ply and entry_depth >= depth:
+                if bound == EXACT:
+                    return score
+                if bound == LOWER:
+                    alpha = max(alpha, score)
+                elif bound == UPPER:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+
+        moves = list(board.legal_moves)
+        if not moves:
+            return -(MATE - ply) if board.is_check() else 0
+
+        original_alpha = alpha
+        best_score, best_move = -MATE, None
+        for move in self._ordered(moves, hash_move):
+            board.push(move)
+            try:
+                score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best_score <= original_alpha:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.table[key] = (depth, bound, best_score, best_move)
+        if ply == 0:
+            self.best_move = best_move
+        return best_score
+
+    def quiesce(self, alpha, beta):
+        self._tick()
+        board = self.board
+        stand_pat = evaluate(board)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        for move in self._ordered(board.generate_legal_captures()):
+            board.push(move)
+            try:
+                score = -self.quiesce(-beta, -alpha)
+            finally:
+                board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+
+def choose_move(fen, history, level, seconds):
+    """Pick a move for the position reached by playing history from fen.
+
+    Runs in engine worker processes, so it takes and returns plain values:
+    a snapshot-style (fen, history) pair, a level from LEVELS and a time
+    budget in seconds. Returns the move in UCI format.
+    """
+    board = chess.Board(fen)
+    for move_uci in history.split():
+        board.push_uci(move_uci)
+    moves = list(board.legal_moves)
+    settings = LEVELS[level]
+    if len(moves) == 1:
+        return moves[0].uci()
+    if random.random() < settings.blunder:
+        return random.choice(moves).uci()
+
+    searcher = Searcher(board, time.monotonic() + min(seconds, settings.seconds))
+    move = searcher.search(settings.depth) or moves[0]
+    if len(_table) > TABLE_MAX_ENTRIES:
+        _table.clear()
+    return move.uci()
@@ -0,0 +1,277 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.polyglot
+from sqlalchemy import select, update
+
+from . import socketio
+from .archive import iter_archived_games
+from .metrics import metrics
+from .models import db, Game, PositionStat
+from .pgn import batch_moves
+
+logger = logging.getLogger(__name__)
+
+# Plies of each game that are indexed; changing it needs a rebuild
+DEFAULT_MAX_PLY = 40
+
+# Result of a game -> the counter it adds to; unfinished results are not counted
+RESULT_COLUMNS = {'1-0': 'white_wins', '1/2-1/2': 'draws', '0-1': 'black_wins'}
+COUNT_COLUMNS = ('games', 'white_wins', 'draws', 'black_wins')
+
+INDEXED_GAMES = metrics.counter('chess_explorer_indexed_games_total', 'Finished games added to the opening explorer')
+
+
+def position_key(board):
+    """Return the board's Zobrist hash as a signed 64-bit integer, as stored in position_stats"""
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def count_positions(games, max_ply=DEFAULT_MAX_PLY):
+    """Tally the moves played from each position of the given games.
+
+    Takes (UCI moves, result) pairs and returns {(key, move): [games,
+    white wins, draws, black wins]}. A position and move that recur within
+    one game count once for it. Runs in worker processes during a rebuild.
+    """
+    counts = {}
+    for uci_moves, result in games:
+        column = COUNT_COLUMNS.index(RESULT_COLUMNS[result])
+        board = chess.Board()
+        seen = set()
+        for move_uci in uci_moves[:max_ply]:
+            entry = (position_key(board), move_uci)
+            if entry not in seen:
+                seen.add(entry)
+                tally = counts.get(entry)
+                if tally is None:
+                    tally = counts[entry] = [0, 0, 0, 0]
+                tally[0] += 1
+                tally[column] += 1
+            try:
+                board.push_uci(move_uci)
+            except ValueError:
+                break
+    return counts
+
+
+def merge_counts(counts, more):
+    """Add the tallies of more into counts"""
+    for entry, tally in more.items():
+        current = counts.get(entry)
+        if current is None:
+            counts[entry] = tally
+        else:
+            for i, value in enumerate(tally):
+                current[i] += value
+    return counts
+
+
+def store_counts(counts):
+    """Add tallies to position_stats in the current transaction.
+
+    Uses one INSERT .. ON CONFLICT DO UPDATE per batch on PostgreSQL and
+    SQLite. Rows are written in key order, so concurrent indexers lock them
+    in the same order and cannot deadlock.
+    """
+    rows = [
+        dict(zip(COUNT_COLUMNS, tally), key=key, move=move)
+        for (key, move), tally in sorted(counts.items())
+    ]
+    if not rows:
+        return
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        _store_counts_slowly(rows)
+        return
+    stmt = insert(PositionStat)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PositionStat.key, PositionStat.move],
+        set_={column: getattr(PositionStat, column) + getattr(stmt.excluded, column) for column in COUNT_COLUMNS}
+    )
+    db.session.execute(stmt, rows)
+
+
+def _store_counts_slowly(rows):
+    for row in rows:
+        result = db.session.execute(
+            update(PositionStat)
+            .where(PositionStat.key == row['key'], PositionStat.move == row['move'])
+            .values({column: getattr(PositionStat, column) + row[column] for column in COUNT_COLUMNS})
+        )
+        if not result.rowcount:
+            db.session.add(PositionStat(**row))
+    db.session.flush()
+
+
+def claim_games(limit):
+    """Mark up to limit finished, unindexed games as indexed and return their (moves, result) pairs.
+
+    The claim is a conditional UPDATE, so a game is only ever counted by the
+    worker whose transaction claims it; the caller commits the claim
+    together with the counts.
+    """
+    candidates = select(Game.id).where(Game.status == 'finished', Game.explored.is_(False)).limit(limit)
+    claimed = db.session.execute(
+        update(Game)
+        .where(Game.id.in_(candidates.scalar_subquery()), Game.explored.is_(False))
+        .values(explored=True, updated_at=Game.updated_at)  # Not a change to the game itself
+        .returning(Game.id, Game.moves, Game.ply_count, Game.result)
+        .execution_options(synchronize_session=False)
+    ).all()
+    moves = batch_moves([row.id for row in claimed if row.ply_count])
+    return [
+        (moves.get(row.id, []) if row.ply_count else (row.moves or '').split(), row.result)
+        for row in claimed if row.result in RESULT_COLUMNS
+    ], len(claimed)
+
+
+def index_pending(batch_size=50, max_ply=DEFAULT_MAX_PLY):
+    """Index one batch of finished games, returning how many were claimed"""
+    games, claimed = claim_games(batch_size)
+    if claimed:
+        store_counts(count_positions(games, max_ply))
+        db.session.commit()
+        INDEXED_GAMES.inc(claimed)
+    return claimed
+
+
+def rebuild_index(workers=None, batch_size=2000, max_ply=DEFAULT_MAX_PLY, progress=None):
+    """Recount position_stats from every finished game, archived ones included.
+
+    Each batch of claimed games is replayed in a process pool, split across
+    the workers, and its tallies are stored with one upsert per batch.
+    Returns the number of games indexed.
+    """
+    workers = workers or os.cpu_count() or 1
+    db.session.execute(update(Game).values(explored=False, updated_at=Game.updated_at)
+                       .execution_options(synchronize_session=False))
+    db.session.execute(PositionStat.__table__.delete())
+    db.session.commit()
+
+    def count(pool, games):
+        chunk = -(-len(games) // workers) or 1
+        counts = {}
+        for more in pool.map(count_positions, [games[i:i + chunk] for i in range(0, len(games), chunk)],
+                             [max_ply] * workers):
+            merge_counts(counts, more)
+        store_counts(counts)
+        db.session.commit()
+
+    indexed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Archived games first: live games are unclaimed until counted below,
+        # so the archiver cannot move one across while this runs
+        for games in iter_archived_games(batch_size):
+            count(pool, [game for game in games if game[1] in RESULT_COLUMNS])
+            indexed += len(games)
+            if progress:
+                progress(indexed)
+        while True:
+            games, claimed = claim_games(batch_size)
+            if not claimed:
+                break
+            count(pool, games)
+            indexed += claimed
+            if progress:
+                progress(indexed)
+    return indexed
+
+
+def explore(board):
+    """Return the aggregated continuations of a position, most played first.
+
+    One primary key range read; no games are replayed.
+    """
+    rows = PositionStat.query.filter_by(key=position_key(board)).order_by(
+        PositionStat.games.desc(), PositionStat.move
+    ).all()
+    moves = []
+    for row in rows:
+        try:
+            move = chess.Move.from_uci(row.move)
+        except ValueError:
+            continue
+        if move not in board.legal_moves:
+            continue  # A Zobrist collision with another position
+        moves.append({
+            'uci': row.move,
+            'san': board.san(move),
+            'games': row.games,
+            'white': row.white_wins,
+            'draws': row.draws,
+            'black': row.black_wins
+        })
+    return {
+        'fen': board.fen(),
+        'games': sum(move['games'] for move in moves),
+        'white': sum(move['white'] for move in moves),
+        'draws': sum(move['draws'] for move in moves),
+        'black': sum(move['black'] for move in moves),
+        'moves': moves
+    }
+
+
+class ExplorerIndexer:
+    """Background task adding finished games to the opening explorer.
+
+    Every ``interval`` seconds it claims up to ``batch_size`` finished games
+    that are not indexed yet and adds their first ``max_ply`` moves to
+    position_stats, so nothing is written on the move path. Batches are
+    small and the task yields between them, since replaying games holds the
+    hub while it runs. The task starts with the first game that finishes
+    in this worker; games finished while no worker was running, or before
+    the explorer existed, are picked up by its first pass.
+    """
+
+    def __init__(self, interval=5.0, batch_size=50, max_ply=DEFAULT_MAX_PLY):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_ply = max_ply
+        self.app = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    def init_app(self, app):
+        """Read indexing settings from the app config"""
+        self.app = app
+        self.interval = app.config.get('EXPLORER_INDEX_INTERVAL', self.interval)
+        self.batch_size = app.config.get('EXPLORER_BATCH_SIZE', self.batch_size)
+        self.max_ply = app.config.get('EXPLORER_MAX_PLY', self.max_ply)
+
+    def start(self):
+        """Start the background task, once; called whenever a game finishes"""
+        with self._lock:
+            if self._task is None and self.app is not None and self.interval:
+                self._task = socketio.start_background_task(self._run_indexer)
+
+    def index_pending(self):
+        """Index every finished game waiting for it, returning how many were indexed"""
+        indexed = 0
+        while True:
+            claimed = index_pending(self.batch_size, self.max_ply)
+            indexed += claimed
+            if claimed < self.batch_size:
+                return indexed
+            socketio.sleep(0)
+
+    def _run_indexer(self):
+        while True:
+            socketio.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.index_pending()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Error indexing games for the opening explorer")
+
+
+explorer_indexer = ExplorerIndexer()
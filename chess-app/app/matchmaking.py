@@ -0,0 +1,242 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from . import socketio
+from .metrics import metrics
+from .clocks import start_clocks
+from .models import db, Game
+from .sockets import user_room, clock_scheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIME_CONTROL = '10+0'
+TIME_CONTROL_PATTERN = re.compile(r'^\d{1,3}\+\d{1,2}$')  # minutes+increment seconds
+
+
+def valid_time_control(time_control):
+    """Return True if the time control looks like '5+3', with a non-zero base time"""
+    if not isinstance(time_control, str) or not TIME_CONTROL_PATTERN.match(time_control):
+        return False
+    return int(time_control.split('+')[0]) > 0
+
+
+class QueueEntry:
+    """A player waiting for an opponent"""
+    __slots__ = ('user_id', 'rating', 'time_control', 'joined_at')
+
+    def __init__(self, user_id, rating, time_control, joined_at=None):
+        self.user_id = user_id
+        self.rating = rating
+        self.time_control = time_control
+        self.joined_at = time.monotonic() if joined_at is None else joined_at
+
+
+class Matchmaker:
+    """In-memory matchmaking queue bucketed by time control and rating.
+
+    Players only meet opponents with the same time control whose rating is
+    within both players' search windows. A window starts at ``base_window``
+    and widens by ``widen_per_second`` while the player waits, up to
+    ``max_window``; set ``widen_per_second`` to 0 for a fixed window. Pairing
+    removes both players under one lock, so nobody can be matched twice.
+    """
+
+    def __init__(self, bucket_size=100, base_window=100, widen_per_second=10,
+                 max_window=800, entry_ttl=300, sweep_interval=2):
+        self.bucket_size = bucket_size
+        self.base_window = base_window
+        self.widen_per_second = widen_per_second
+        self.max_window = max_window
+        self.entry_ttl = entry_ttl
+        self.sweep_interval = sweep_interval
+        self._buckets = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.matches = 0
+        self.expired = 0
+
+    def init_app(self, app):
+        """Read queue settings from the app config"""
+        self.base_window = app.config.get('MATCHMAKING_BASE_WINDOW', self.base_window)
+        self.widen_per_second = app.config.get('MATCHMAKING_WIDEN_PER_SECOND', self.widen_per_second)
+        self.max_window = app.config.get('MATCHMAKING_MAX_WINDOW', self.max_window)
+        self.entry_ttl = app.config.get('MATCHMAKING_ENTRY_TTL', self.entry_ttl)
+        self.sweep_interval = app.config.get('MATCHMAKING_SWEEP_INTERVAL', self.sweep_interval)
+
+    def join(self, user_id, rating, time_control, now=None):
+        """Pair the player with a waiting opponent, or queue them.
+
+        Returns the opponent's entry, which has been removed from the queue,
+        or None if the player is now waiting.
+        """
+        now = time.monotonic() if now is None else now
+        entry = QueueEntry(user_id, rating, time_control, now)
+        with self._lock:
+            if user_id in self._entries:
+                return None
+            opponent = self._find_opponent(entry, now)
+            if opponent:
+                self._remove(opponent)
+                self.matches += 1
+                return opponent
+            self._add(entry)
+            return None
+
+    def leave(self, user_id):
+        """Remove a player from the queue, returning True if they were waiting"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry:
+                self._remove(entry)
+            return entry is not None
+
+    def requeue(self, entry):
+        """Put back a player whose match could not be created"""
+        with self._lock:
+            if entry.user_id not in self._entries:
+                self._add(entry)
+
+    def sweep(self, now=None):
+        """Expire stale entries and pair players whose windows now overlap.
+
+        Returns (expired entries, list of (older, newer) entry pairs).
+        """
+        now = time.monotonic() if now is None else now
+        expired, pairs = [], []
+        with self._lock:
+            for entry in sorted(self._entries.values(), key=lambda e: e.joined_at):
+                if entry.user_id not in self._entries:
+                    continue  # Already paired during this sweep
+                if self.entry_ttl and now - entry.joined_at > self.entry_ttl:
+                    self._remove(entry)
+                    expired.append(entry)
+                    continue
+                opponent = self._find_opponent(entry, now)
+                if opponent:
+                    self._remove(entry)
+                    self._remove(opponent)
+                    pairs.append((entry, opponent))
+                    self.matches += 1
+            self.expired += len(expired)
+        return expired, pairs
+
+    def window(self, entry, now):
+        """Return how far from their own rating a player will accept an opponent"""
+        widened = self.base_window + self.widen_per_second * (now - entry.joined_at)
+        return min(max(widened, self.base_window), self.max_window)
+
+    def _find_opponent(self, entry, now):
+        window = self.window(entry, now)
+        low = int((entry.rating - window) // self.bucket_size)
+        high = int((entry.rating + window) // self.bucket_size)
+        best = None
+        for bucket_index in range(low, high + 1):
+            bucket = self._buckets.get((entry.time_control, bucket_index))
+            if not bucket:
+                continue
+            # Buckets are in arrival order, so the first eligible entry has waited longest
+            for candidate in bucket.values():
+                if candidate.user_id == entry.user_id:
+                    continue
+                reach = min(window, self.window(candidate, now))
+                if abs(candidate.rating - entry.rating) <= reach:
+                    if best is None or candidate.joined_at < best.joined_at:
+                        best = candidate
+                    break
+        return best
+
+    def _bucket_key(self, entry):
+        return (entry.time_control, int(entry.rating // self.bucket_size))
+
+    def _add(self, entry):
+        self._entries[entry.user_id] = entry
+        self._buckets.setdefault(self._bucket_key(entry), OrderedDict())[entry.user_id] = entry
+
+    def _remove(self, entry):
+        self._entries.pop(entry.user_id, None)
+        key = self._bucket_key(entry)
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.pop(entry.user_id, None)
+            if not bucket:
+                del self._buckets[key]
+
+    def ensure_sweeper(self, app):
+        """Start the background task that widens windows and expires entries"""
+        with self._lock:
+            if self._sweeper is not None or not self.sweep_interval:
+                return
+            self._sweeper = socketio.start_background_task(self._run_sweeper, app)
+
+    def _run_sweeper(self, app):
+        while True:
+            socketio.sleep(self.sweep_interval)
+            expired, pairs = self.sweep()
+            for entry in expired:
+                socketio.emit('queue_expired', {
+                    'message': 'No opponent found, please search again.'
+                }, to=user_room(entry.user_id))
+            if pairs:
+                with app.app_context():
+                    for older, newer in pairs:
+                        try:
+                            create_match(older, newer, notify=(older, newer))
+                        except Exception:
+                            logger.exception("Error creating matched game")
+                            self.requeue(older)
+                            self.requeue(newer)
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return user_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Return queue depth and counters"""
+        with self._lock:
+            return {
+                'waiting': len(self._entries),
+                'buckets': len(self._buckets),
+                'matches': self.matches,
+                'expired': self.expired
+            }
+
+
+def create_match(white, black, notify=()):
+    """Create the game for a matched pair and push it to the given players"""
+    now = datetime.utcnow()
+    game = Game(
+        player_white_id=white.user_id,
+        player_black_id=black.user_id,
+        status='active',
+        time_control=white.time_control,
+        created_at=now
+    )
+    start_clocks(game, now)
+    db.session.add(game)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    clock_scheduler.arm(game)
+
+    for entry in notify:
+        socketio.emit('match_found', {
+            'game_id': game.id,
+            'color': 'white' if entry is white else 'black',
+            'time_control': white.time_control
+        }, to=user_room(entry.user_id))
+    return game
+
+
+matchmaker = Matchmaker()
+metrics.callback('chess_matchmaking_queue_depth', 'Players waiting in the matchmaking queue', lambda: len(matchmaker))
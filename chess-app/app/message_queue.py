@@ -0,0 +1,50 @@
+import socketio
+
+# Channel shared by every worker, matching Flask-SocketIO's default
+DEFAULT_CHANNEL = 'flask-socketio'
+
+
+class LocalManager(socketio.PubSubManager):
+    """In-process pub/sub backend standing in for Redis in tests and benchmarks.
+
+    Every LocalManager on the same channel receives every published message,
+    so several Socket.IO servers in one process behave like workers sharing
+    a real message queue. Messages are JSON encoded on the way through, as
+    they would be on a real broker.
+    """
+    name = 'local'
+    subscribers = {}
+
+    def __init__(self, url='local://', channel=DEFAULT_CHANNEL, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = None
+
+    def initialize(self):
+        if not self.write_only:
+            self.queue = self.server.eio.create_queue()
+            self.subscribers.setdefault(self.channel, []).append(self.queue)
+        super().initialize()
+
+    def _publish(self, data):
+        message = self.json.dumps(data)
+        for queue in list(self.subscribers.get(self.channel, ())):
+            queue.put(message)
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+
+def message_queue_options(url, channel=DEFAULT_CHANNEL):
+    """Return SocketIO.init_app() options for a message queue URL.
+
+    ``local://`` selects the in-process LocalManager; any other URL
+    (``redis://``, ``amqp://``, ``kafka://``...) is handed to Flask-SocketIO,
+    which picks the matching python-socketio manager. With no URL the app
+    runs as a single worker.
+    """
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalManager(url, channel=channel)}
+    return {'message_queue': url, 'channel': channel}
@@ -0,0 +1,224 @@
+import bisect
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from sub-millisecond moves to slow commits
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in key) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels"""
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the running sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        result = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append((f'{self.name}_bucket', key + (('le', _format_value(bound)),), cumulative))
+            result.append((f'{self.name}_sum', key, counts[-1]))
+            result.append((f'{self.name}_count', key, cumulative))
+        return result
+
+
+class CallbackMetric:
+    """Metric read from a callback at scrape time, such as a cache size.
+
+    The callback returns a number, or a dict of {label value: number} when
+    the metric is split by ``label``.
+    """
+
+    def __init__(self, name, help, callback, type='gauge', label=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.type = type
+        self.label = label
+
+    def samples(self):
+        value = self.callback()
+        if self.label is None:
+            return [(self.name, (), value)]
+        return [(self.name, ((self.label, key),), v) for key, v in value.items()]
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format.
+
+    Histograms observed through ``timed`` are sampled at ``sample_rate`` so
+    the hot path can trade precision for overhead; counters always count.
+    Profile hooks receive a cProfile.Profile for a sampled fraction
+    (``profile_rate``) of the sections wrapped in ``profiled``.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.sample_rate = 1.0
+        self.profile_rate = 0.0
+        self._profile_hooks = []
+
+    def init_app(self, app):
+        """Read sampling settings from the app config"""
+        self.sample_rate = app.config.get('METRICS_SAMPLE_RATE', self.sample_rate)
+        self.profile_rate = app.config.get('METRICS_PROFILE_RATE', self.profile_rate)
+
+    def _register(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def counter(self, name, help):
+        return self._register(name, lambda: Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._register(name, lambda: Gauge(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(name, lambda: Histogram(name, help, buckets))
+
+    def callback(self, name, help, callback, type='gauge', label=None):
+        """Register a metric whose value is read from callback() when scraped"""
+        with self._lock:
+            self._metrics[name] = CallbackMetric(name, help, callback, type, label)
+            return self._metrics[name]
+
+    @contextmanager
+    def timed(self, histogram, **labels):
+        """Observe the duration of the block in a histogram, if sampled"""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start, **labels)
+
+    def add_profile_hook(self, hook):
+        """Call hook(name, profile) with a cProfile.Profile of sampled profiled() blocks"""
+        if hook not in self._profile_hooks:
+            self._profile_hooks.append(hook)
+
+    @contextmanager
+    def profiled(self, name):
+        """Run the block under cProfile for a sampled fraction of calls"""
+        if not self._profile_hooks or not self.profile_rate or random.random() >= self.profile_rate:
+            yield
+            return
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            for hook in list(self._profile_hooks):
+                hook(name, profile)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, key, value in metric.samples():
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def log_profile(name, profile, limit=15):
+    """Profile hook that logs the most expensive calls of a profiled block"""
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(limit)
+    logger.info("Profile of %s:\n%s", name, out.getvalue())
+
+
+metrics = Registry()
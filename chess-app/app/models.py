@@ -1,5 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import struct
+import zlib
+
+import chess
 
 db = SQLAlchemy()
 
@@ -9,6 +13,8 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
+    rating = db.Column(db.Integer, nullable=False, default=1200, server_default='1200')
+    bot_level = db.Column(db.Integer, nullable=True)  # Engine strength of computer players, null for people
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # Relationships
@@ -23,34 +29,237 @@ class Game(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     player_white_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     player_black_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Allow null for waiting games
-    moves = db.Column(db.Text, nullable=True, default='')  # Store moves in UCI format
+    moves = db.Column(db.Text, nullable=True, default='')  # Legacy UCI move string, migrated into game_moves
+    ply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Number of moves in game_moves
     status = db.Column(db.String(20), nullable=False, default='waiting')  # waiting, active, finished
     result = db.Column(db.String(10), nullable=True)  # 1-0, 0-1, 1/2-1/2, *
+    time_control = db.Column(db.String(10), nullable=True)  # minutes+increment, e.g. 5+3; null for untimed games
+    white_clock_ms = db.Column(db.Integer, nullable=True)  # Time left after white's last move
+    black_clock_ms = db.Column(db.Integer, nullable=True)  # Time left after black's last move
+    clock_started_at = db.Column(db.DateTime, nullable=True)  # When the side to move's clock started running
+    draw_offer = db.Column(db.String(5), nullable=True)  # Color with a standing draw offer, if any
+    explored = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())  # Counted in position_stats
+    tournament_id = db.Column(db.Integer, db.ForeignKey('tournaments.id'), nullable=True)  # Null for casual games
+    round = db.Column(db.Integer, nullable=True)  # Tournament round, or pairing wave in arenas
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # ply_count doubles as an optimistic lock: updates only apply if no other
+    # move was stored since the row was read, otherwise StaleDataError is raised
+    __mapper_args__ = {'version_id_col': ply_count, 'version_id_generator': False}
+
+    # Cover the per-player game history, newest first, for keyset pagination
+    __table_args__ = (
+        db.Index('ix_games_white_updated', 'player_white_id', 'updated_at', 'id'),
+        db.Index('ix_games_black_updated', 'player_black_id', 'updated_at', 'id'),
+        db.Index('ix_games_explored_status', 'explored', 'status'),  # Finds games the explorer has not indexed
+        db.Index('ix_games_status_updated', 'status', 'updated_at'),  # Live games, and finished games due for archiving
+        db.Index('ix_games_tournament_round', 'tournament_id', 'round'),
+        # Archived ids must never be handed out again to a new game
+        {'sqlite_autoincrement': True},
+    )
+
     def __repr__(self):
         return f"<Game {self.id} | White: {self.player_white_id} Black: {self.player_black_id} Status: {self.status}>"
     
     def get_moves_list(self):
         """Return moves as a list"""
-        return self.moves.split() if self.moves else []
+        return list(self.iter_moves())
+
+    def iter_moves(self, start_ply=0, batch_size=500):
+        """Stream moves in UCI format, skipping the first start_ply of them"""
+        if self.moves and not self.ply_count:
+            yield from self.moves.split()[start_ply:]
+            return
+        query = db.session.query(GameMove.uci).filter(
+            GameMove.game_id == self.id,
+            GameMove.ply > start_ply
+        ).order_by(GameMove.ply).yield_per(batch_size)
+        for (move_uci,) in query:
+            yield move_uci
     
-    def add_move(self, move_uci):
-        """Add a move to the game"""
-        moves_list = self.get_moves_list()
-        moves_list.append(move_uci)
-        self.moves = ' '.join(moves_list)
-        self.updated_at = datetime.utcnow()
-
-# Waiting queue for matchmaking
-class WaitingQueue(db.Model):
-    __tablename__ = 'waiting_queue'
+    def add_move(self, move_uci, played_at=None):
+        """Append a move to the game"""
+        played_at = played_at or datetime.utcnow()
+        self.migrate_legacy_moves()
+        self.ply_count = (self.ply_count or 0) + 1
+        db.session.add(GameMove(game_id=self.id, ply=self.ply_count, uci=move_uci, created_at=played_at))
+        self.updated_at = played_at
+
+    def migrate_legacy_moves(self):
+        """Move a legacy space-separated move string into game_moves rows"""
+        if not self.moves:
+            return False
+        if not self.ply_count:
+            moves_list = self.moves.split()
+            db.session.add_all([
+                GameMove(game_id=self.id, ply=ply, uci=move_uci)
+                for ply, move_uci in enumerate(moves_list, start=1)
+            ])
+            self.ply_count = len(moves_list)
+        self.moves = None
+        return True
+
+# One row per half-move, appended as the game is played
+class GameMove(db.Model):
+    __tablename__ = 'game_moves'
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), primary_key=True)
+    ply = db.Column(db.Integer, primary_key=True)  # 1 for white's first move
+    uci = db.Column(db.String(5), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<GameMove {self.game_id}:{self.ply} {self.uci}>"
+
+# Latest position checkpoint per game, so boards can be rebuilt without a full replay
+class GameSnapshot(db.Model):
+    __tablename__ = 'game_snapshots'
+    game_id = db.Column(db.Integer, db.ForeignKey('games.id'), primary_key=True)
+    ply = db.Column(db.Integer, nullable=False)  # Ply the snapshot was taken at
+    fen = db.Column(db.String(100), nullable=False)  # Position at the last pawn move or capture before ply
+    history = db.Column(db.Text, nullable=False, default='')  # UCI moves from fen up to ply
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<GameSnapshot {self.game_id} at ply {self.ply}>"
+# Opening explorer: how often each move was played from a position, and how those games ended
+class PositionStat(db.Model):
+    __tablename__ = 'position_stats'
+    key = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # Zobrist hash as a signed 64-bit integer
+    move = db.Column(db.String(5), primary_key=True)  # UCI move played from the position
+    games = db.Column(db.Integer, nullable=False, default=0)
+    white_wins = db.Column(db.Integer, nullable=False, default=0)
+    draws = db.Column(db.Integer, nullable=False, default=0)
+    black_wins = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<PositionStat {self.key} {self.move}: {self.games} games>"
+
+# Swiss or arena event; games of a round are created in bulk by the tournament director
+class Tournament(db.Model):
+    __tablename__ = 'tournaments'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(80), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # swiss or arena
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, running, finished
+    time_control = db.Column(db.String(10), nullable=False)
+    rounds = db.Column(db.Integer, nullable=True)  # Rounds of a swiss
+    duration_minutes = db.Column(db.Integer, nullable=True)  # Length of an arena
+    current_round = db.Column(db.Integer, nullable=False, default=0)  # Last round paired
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    user = db.relationship('User', backref='queue_entries')
-    
+    started_at = db.Column(db.DateTime, nullable=True)
+    ends_at = db.Column(db.DateTime, nullable=True)  # When an arena stops pairing
+    finished_at = db.Column(db.DateTime, nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    # Pairing bumps version, so two workers pairing the same round cannot both commit
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        db.Index('ix_tournaments_status', 'status'),
+    )
+
+    def __repr__(self):
+        return f"<Tournament {self.id} {self.kind} {self.status} round {self.current_round}>"
+
+class TournamentPlayer(db.Model):
+    __tablename__ = 'tournament_players'
+    tournament_id = db.Column(db.Integer, db.ForeignKey('tournaments.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    rating = db.Column(db.Integer, nullable=False)  # Rating when the player joined, used to seed pairings
+    score = db.Column(db.Integer, nullable=False, default=0)  # Half-points: 2 per win or bye, 1 per draw
+    games = db.Column(db.Integer, nullable=False, default=0)  # Finished games
+    byes = db.Column(db.Integer, nullable=False, default=0)
+    withdrawn = db.Column(db.Boolean, nullable=False, default=False)  # No longer paired
+    joined_at = db.Column(db.DateTime, default=datetime.utcnow)  # When the player last joined or rejoined
+
+    user = db.relationship('User')
+
+    # Standings, best first
+    __table_args__ = (
+        db.Index('ix_tournament_players_standings', 'tournament_id', 'score', 'rating'),
+    )
+
+    def __repr__(self):
+        return f"<TournamentPlayer {self.tournament_id}:{self.user_id} score {self.score / 2}>"
+
+# Finished games moved out of games by the archiver. One partition per month
+# on PostgreSQL; the moves of a game are packed into one compressed blob
+class ArchivedGame(db.Model):
+    __tablename__ = 'archived_games'
+    archive_month = db.Column(db.Integer, primary_key=True, autoincrement=False)  # year * 100 + month the game ended
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Id the game had in games
+    player_white_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    player_black_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    result = db.Column(db.String(10), nullable=True)
+    time_control = db.Column(db.String(10), nullable=True)
+    white_clock_ms = db.Column(db.Integer, nullable=True)
+    black_clock_ms = db.Column(db.Integer, nullable=True)
+    tournament_id = db.Column(db.Integer, nullable=True)
+    round = db.Column(db.Integer, nullable=True)
+    ply_count = db.Column(db.Integer, nullable=False, default=0)
+    packed_moves = db.Column(db.LargeBinary, nullable=False)  # See pack_moves()
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    white_player = db.relationship('User', foreign_keys=[player_white_id])
+    black_player = db.relationship('User', foreign_keys=[player_black_id])
+
+    __table_args__ = (
+        db.Index('ix_archived_games_id', 'id'),
+        db.Index('ix_archived_games_white_updated', 'player_white_id', 'updated_at', 'id'),
+        db.Index('ix_archived_games_black_updated', 'player_black_id', 'updated_at', 'id'),
+        {'postgresql_partition_by': 'LIST (archive_month)'},
+    )
+
+    # Read like a finished Game by the game page, sockets and clocks
+    status = 'finished'
+    moves = None
+    draw_offer = None
+    clock_started_at = None
+
     def __repr__(self):
-        return f"<WaitingQueue user_id: {self.user_id}>"
\ No newline at end of file
+        return f"<ArchivedGame {self.id} | {self.archive_month} Result: {self.result}>"
+
+    def get_moves_list(self):
+        """Return moves as a list"""
+        return unpack_moves(self.packed_moves)
+
+    def iter_moves(self, start_ply=0, batch_size=None):
+        """Stream moves in UCI format, skipping the first start_ply of them"""
+        yield from unpack_moves(self.packed_moves)[start_ply:]
+
+
+def archive_month(when):
+    """Return the archive partition key of a game that ended at when, e.g. 202610"""
+    return when.year * 100 + when.month
+
+
+# Promotion piece <-> 3-bit code in a packed move; 0 is no promotion
+_PROMOTIONS = (None, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)
+
+
+def pack_moves(uci_moves):
+    """Encode UCI moves as 16 bits each (from, to, promotion) and compress them.
+
+    Raises ValueError for a move that is not valid UCI.
+    """
+    codes = []
+    for move_uci in uci_moves:
+        move = chess.Move.from_uci(move_uci)
+        if not move:
+            raise ValueError(f"Cannot archive null move {move_uci!r}")
+        codes.append(move.from_square | move.to_square << 6 | _PROMOTIONS.index(move.promotion) << 12)
+    return zlib.compress(struct.pack(f'<{len(codes)}H', *codes))
+
+
+def unpack_moves(blob):
+    """Decode the UCI moves of a pack_moves() blob"""
+    raw = zlib.decompress(blob)
+    moves = []
+    for code in struct.unpack(f'<{len(raw) // 2}H', raw):
+        move = chess.Move(code & 63, code >> 6 & 63, _PROMOTIONS[code >> 12])
+        moves.append(move.uci())
+    return moves
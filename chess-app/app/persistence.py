@@ -0,0 +1,456 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; journals are not locked there
+    fcntl = None
+
+from sqlalchemy.orm import joinedload
+
+from . import socketio
+from .archive import load_archived_game
+from .metrics import metrics
+from .models import db, Game, GameMove
+from .snapshots import (DEFAULT_SNAPSHOT_INTERVAL, load_board, maybe_snapshot, snapshot_due,
+                        snapshot_fields, store_snapshot)
+
+logger = logging.getLogger(__name__)
+
+SYNC = 'sync'
+WRITE_BEHIND = 'write-behind'
+FSYNC_MODES = ('always', 'interval', 'off')
+
+# Journal locks this process holds. Forked children, such as the password
+# and engine pools, drop their copies so they cannot keep a journal locked
+# once the worker that took it has died
+_journal_locks = set()
+
+
+def _drop_journal_locks():
+    for lock_file in _journal_locks:
+        lock_file.close()
+    _journal_locks.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_drop_journal_locks)
+
+# Game columns carried by every journal record, besides the ply and clock start
+GAME_FIELDS = ('status', 'result', 'white_clock_ms', 'black_clock_ms', 'draw_offer')
+
+GROUP_COMMIT_SECONDS = metrics.histogram('chess_group_commit_seconds', 'Time spent committing a batch of journaled moves')
+GROUP_COMMIT_RECORDS = metrics.histogram('chess_group_commit_records', 'Journal records written per group commit',
+                                         buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+def _datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+class MoveJournal:
+    """Append-only log of accepted moves, split into numbered segment files.
+
+    Each record is one JSON line. ``rotate`` seals the segment being
+    written so it can be deleted once everything in it has been committed;
+    the next append starts a new segment. A journal belongs to one process:
+    ``lock`` takes an exclusive lock on the directory before it is replayed
+    or written, so a second process pointed at it fails instead of
+    replaying, deleting or appending to segments that are still in use.
+    """
+
+    def __init__(self, path, fsync='always'):
+        self.path = path
+        self.fsync = fsync
+        self._file = None
+        self._seq = None
+        self._lock_file = None
+
+    def segments(self):
+        """Return the paths of all segments on disk, oldest first"""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.startswith('moves-') and name.endswith('.log')
+        )
+
+    def is_open(self):
+        return self._file is not None
+
+    def lock(self):
+        """Lock the journal directory for this process, raising RuntimeError if another holds it"""
+        if self._lock_file is not None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, 'journal.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise RuntimeError(f"Journal {self.path} is in use by another process; "
+                                   f"give each worker its own JOURNAL_PATH") from None
+        self._lock_file = lock_file
+        _journal_locks.add(lock_file)
+
+    def close(self):
+        """Close the current segment without sealing it and release the directory"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._lock_file is not None:
+            _journal_locks.discard(self._lock_file)
+            self._lock_file.close()  # Closing it releases the lock
+            self._lock_file = None
+
+    def append(self, record):
+        """Write a record to the current segment, syncing it to disk if configured"""
+        if self._file is None:
+            self._open()
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        if self.fsync == 'always':
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Close the current segment and return its path, or None if nothing was written"""
+        if self._file is None:
+            return None
+        if self.fsync == 'interval':
+            os.fsync(self._file.fileno())
+        path = self._file.name
+        self._file.close()
+        self._file = None
+        return path
+
+    def _open(self):
+        self.lock()
+        if self._seq is None:
+            existing = self.segments()
+            self._seq = int(os.path.basename(existing[-1])[6:-4]) if existing else 0
+        self._seq += 1
+        self._file = open(os.path.join(self.path, f'moves-{self._seq:010d}.log'), 'a')
+
+    @staticmethod
+    def read(path):
+        """Yield the records of a segment, stopping at a torn final line"""
+        with open(path) as f:
+            for number, line in enumerate(f, start=1):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring unreadable journal record at %s:%d", path, number)
+                    return
+
+
+def write_records(records):
+    """Apply journal records to the database in one transaction.
+
+    Records the database already reflects are skipped, so a journal can be
+    replayed more than once.
+    """
+    games = {game.id: game for game in Game.query.filter(Game.id.in_({r['game_id'] for r in records}))}
+    moves = []
+    for record in records:
+        game = games.get(record['game_id'])
+        if game is None:
+            continue
+        if record['move'] is not None:
+            if record['ply'] != game.ply_count + 1:
+                continue
+            moves.append(GameMove(game_id=game.id, ply=record['ply'], uci=record['move'],
+                                  created_at=_datetime(record['played_at'])))
+            game.ply_count = record['ply']
+        elif record['ply'] != game.ply_count:
+            continue
+        for field in GAME_FIELDS:
+            setattr(game, field, record.get(field))  # Older journals lack newer fields
+        game.clock_started_at = _datetime(record['clock_started_at'])
+        game.updated_at = _datetime(record['played_at'])
+        if record.get('snapshot'):
+            store_snapshot(game.id, record['ply'], *record['snapshot'])
+    db.session.add_all(moves)
+    db.session.commit()
+
+
+class MoveStore:
+    """Persists accepted moves, either synchronously or write-behind.
+
+    In ``sync`` mode every move is committed to the database before it is
+    broadcast. In ``write-behind`` mode a move is appended to a local journal
+    and acknowledged at once; a background task writes queued moves to the
+    database every ``interval`` seconds, in group commits of up to
+    ``max_batch`` records. Moves that are not committed yet are merged into
+    the games, move lists and boards read through the store, and a journal
+    left by a previous run is replayed on startup.
+
+    ``fsync`` bounds what a crash can lose: 'always' syncs every append,
+    'interval' syncs once per group commit and 'off' leaves it to the OS.
+    Once ``max_pending`` records are waiting, movers flush inline. Write-behind
+    assumes each game's moves are only made on this worker.
+    """
+
+    def __init__(self):
+        self.mode = SYNC
+        self.interval = 0.05
+        self.max_batch = 500
+        self.max_pending = 10000
+        self.snapshot_interval = DEFAULT_SNAPSHOT_INTERVAL
+        self.journal = None
+        self.app = None
+        self._pending = {}
+        self._queue = []
+        self._sealed = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self.committed = 0
+
+    def init_app(self, app):
+        """Read the persistence mode and durability settings from the app config"""
+        self.app = app
+        self.mode = app.config.get('PERSISTENCE_MODE', self.mode)
+        if self.mode not in (SYNC, WRITE_BEHIND):
+            raise ValueError(f"Unknown PERSISTENCE_MODE {self.mode!r}")
+        fsync = app.config.get('JOURNAL_FSYNC', 'always')
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"Unknown JOURNAL_FSYNC {fsync!r}")
+        self.interval = app.config.get('WRITE_BEHIND_INTERVAL', self.interval)
+        self.max_batch = app.config.get('WRITE_BEHIND_MAX_BATCH', self.max_batch)
+        self.max_pending = app.config.get('WRITE_BEHIND_MAX_PENDING', self.max_pending)
+        self.snapshot_interval = app.config.get('SNAPSHOT_INTERVAL', self.snapshot_interval)
+        path = app.config.get('JOURNAL_PATH') or os.path.join(app.instance_path, 'journal')
+        if self.journal is None or self.journal.path != path:
+            self.journal = MoveJournal(path, fsync)
+        self.journal.fsync = fsync
+
+    @property
+    def write_behind(self):
+        return self.mode == WRITE_BEHIND
+
+    # Reads
+
+    def load_game(self, game_id):
+        """Return a game with any moves that are not committed yet applied to it.
+
+        In write-behind mode the game comes detached from the session, with
+        both players loaded, so changes made to it are only ever written
+        through the journal. Games that are no longer in the games table
+        are read from the archive.
+        """
+        if not self.write_behind:
+            return db.session.get(Game, game_id) or load_archived_game(game_id)
+
+        # Read the queue first: a record committed meanwhile is then in both
+        last = self._pending_records(game_id)[-1:]
+        game = Game.query.options(
+            joinedload(Game.white_player), joinedload(Game.black_player)
+        ).filter(Game.id == game_id).first()
+        if game is None:
+            return load_archived_game(game_id)
+        if game.migrate_legacy_moves():
+            db.session.commit()
+            return self.load_game(game_id)
+        db.session.expunge(game)
+
+        if last and last[0]['ply'] >= game.ply_count:
+            record = last[0]
+            game.ply_count = record['ply']
+            for field in GAME_FIELDS:
+                setattr(game, field, record.get(field))
+            game.clock_started_at = _datetime(record['clock_started_at'])
+            game.updated_at = _datetime(record['played_at'])
+        return game
+
+    def iter_moves(self, game, start_ply=0):
+        """Stream a game's moves in UCI format, including those not committed yet"""
+        pending = self._pending_records(game.id)
+        ply = start_ply
+        for move_uci in game.iter_moves(start_ply=start_ply):
+            ply += 1
+            yield move_uci
+        for record in pending:
+            if record['move'] is not None and record['ply'] == ply + 1:
+                ply += 1
+                yield record['move']
+
+    def load_board(self, game):
+        """Rebuild a game's board from the database and the moves not committed yet"""
+        pending = self._pending_records(game.id)
+        board = load_board(game)
+        for record in pending:
+            if record['move'] is not None and record['ply'] == board.ply() + 1:
+                board.push_uci(record['move'])
+        return board
+
+    def _pending_records(self, game_id):
+        with self._lock:
+            return list(self._pending.get(game_id, ()))
+
+    # Writes
+
+    def persist_move(self, game, board, move_uci, played_at):
+        """Store a move that was just pushed onto the game's board"""
+        if not self.write_behind:
+            game.add_move(move_uci, played_at=played_at)
+            maybe_snapshot(game, board, self.snapshot_interval)
+            db.session.commit()
+            return
+
+        game.ply_count += 1
+        game.updated_at = played_at
+        snapshot = snapshot_fields(board) if snapshot_due(game.ply_count, self.snapshot_interval) else None
+        self._append(self._record(game, move_uci, played_at, snapshot))
+
+    def persist_game(self, game, now):
+        """Store changes to a game that came without a move, such as a flag fall"""
+        if not self.write_behind:
+            db.session.commit()
+            return
+        game.updated_at = now
+        self._append(self._record(game, None, now))
+
+    def _record(self, game, move_uci, played_at, snapshot=None):
+        record = {
+            'game_id': game.id,
+            'ply': game.ply_count,
+            'move': move_uci,
+            'played_at': _isoformat(played_at),
+            'clock_started_at': _isoformat(game.clock_started_at),
+            'snapshot': snapshot
+        }
+        for field in GAME_FIELDS:
+            record[field] = getattr(game, field)
+        return record
+
+    def _append(self, record):
+        with self._lock:
+            self.journal.append(record)
+            self._queue.append(record)
+            self._pending.setdefault(record['game_id'], []).append(record)
+            backlog = len(self._queue)
+            if self._flusher is None and self.app is not None:
+                self._flusher = socketio.start_background_task(self._run_flusher)
+        if backlog >= self.max_pending:
+            # The database is falling behind, so this mover waits for a commit;
+            # its own record is already journaled either way
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error committing journaled moves")
+
+    # Group commit
+
+    def flush(self):
+        """Commit every queued record to the database, returning how many were written"""
+        if not self._flush_lock.acquire(blocking=False):
+            return 0
+        try:
+            with self._lock:
+                sealed = self.journal.rotate()
+                if sealed:
+                    self._sealed.append(sealed)
+                batch, self._queue = self._queue, []
+            if not batch:
+                return 0
+
+            written = 0
+            try:
+                for start in range(0, len(batch), self.max_batch):
+                    chunk = batch[start:start + self.max_batch]
+                    with metrics.timed(GROUP_COMMIT_SECONDS):
+                        write_records(chunk)
+                    GROUP_COMMIT_RECORDS.observe(len(chunk))
+                    self._release(chunk)
+                    written += len(chunk)
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._queue[:0] = batch[written:]
+                raise
+            finally:
+                self.committed += written
+
+            # Every sealed segment is now in the database
+            with self._lock:
+                sealed, self._sealed = self._sealed, []
+            for path in sealed:
+                os.remove(path)
+            return written
+        finally:
+            self._flush_lock.release()
+
+    def _release(self, records):
+        with self._lock:
+            for record in records:
+                pending = self._pending.get(record['game_id'])
+                if pending and pending[0] is record:
+                    pending.pop(0)
+                    if not pending:
+                        del self._pending[record['game_id']]
+
+    def _run_flusher(self):
+        while True:
+            socketio.sleep(self.interval)
+            if not self._queue:
+                continue
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Error committing journaled moves")
+
+    def replay(self):
+        """Write the records of a journal left by a previous run to the database.
+
+        In write-behind mode the journal stays locked to this process
+        afterwards; raises RuntimeError if another process has it.
+        """
+        if self.journal is None or self.journal.is_open() or self._queue or self._sealed:
+            return 0
+        if not self.write_behind and not self.journal.segments():
+            return 0
+        self.journal.lock()
+        replayed = 0
+        try:
+            for path in self.journal.segments():
+                records = list(MoveJournal.read(path))
+                for start in range(0, len(records), self.max_batch):
+                    write_records(records[start:start + self.max_batch])
+                os.remove(path)
+                replayed += len(records)
+        finally:
+            if not self.write_behind:
+                self.journal.close()  # Nothing else writes to it in sync mode
+        if replayed:
+            logger.info("Replayed %d journaled records into the database", replayed)
+        return replayed
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
+
+    def stats(self):
+        """Return the persistence mode and write-behind counters"""
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'queued': len(self._queue),
+                'games': len(self._pending),
+                'sealed_segments': len(self._sealed),
+                'committed': self.committed
+            }
+
+
+move_store = MoveStore()
+metrics.callback('chess_journaled_moves', 'Journaled records waiting for a group commit', lambda: len(move_store))
+metrics.callback('chess_group_committed_records_total', 'Journaled records written to the database',
+                 lambda: move_store.committed, type='counter')
@@ -0,0 +1,302 @@
+import io
+import logging
+import os
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import chess
+import chess.pgn
+from sqlalchemy import insert, literal, select
+from sqlalchemy.orm import aliased
+
+from .models import db, User, ArchivedGame, Game, GameMove, unpack_moves
+
+logger = logging.getLogger(__name__)
+
+PGN_EVENT = 'Chess Capstone game'
+PGN_RESULTS = {'1-0', '0-1', '1/2-1/2', '*'}
+IMPORTED_EMAIL_DOMAIN = 'imported.invalid'
+UNUSABLE_PASSWORD = '!'  # Never matches, so imported players cannot log in
+
+
+# Export
+
+def export_query(user_id=None, statuses=None):
+    """Select the rows needed to export games, oldest first"""
+    white = aliased(User)
+    black = aliased(User)
+    query = select(
+        Game.id, Game.moves, Game.ply_count, Game.result, Game.status, Game.time_control,
+        Game.created_at, white.username.label('white'), black.username.label('black')
+    ).join(white, Game.player_white_id == white.id).outerjoin(black, Game.player_black_id == black.id)
+    if user_id is not None:
+        query = query.where((Game.player_white_id == user_id) | (Game.player_black_id == user_id))
+    if statuses:
+        query = query.where(Game.status.in_(statuses))
+    return query.order_by(Game.id)
+
+
+def export_archive_query(user_id=None, statuses=None):
+    """Select the rows needed to export archived games, oldest first, or None if statuses excludes them"""
+    if statuses and 'finished' not in statuses:
+        return None
+    white = aliased(User)
+    black = aliased(User)
+    query = select(
+        ArchivedGame.id, ArchivedGame.packed_moves, ArchivedGame.ply_count, ArchivedGame.result,
+        literal('finished').label('status'), ArchivedGame.time_control, ArchivedGame.created_at,
+        white.username.label('white'), black.username.label('black')
+    ).join(white, ArchivedGame.player_white_id == white.id).outerjoin(black, ArchivedGame.player_black_id == black.id)
+    if user_id is not None:
+        query = query.where((ArchivedGame.player_white_id == user_id) | (ArchivedGame.player_black_id == user_id))
+    return query.order_by(ArchivedGame.id)
+
+
+def export_games(user_id=None, statuses=None, batch_size=500):
+    """Yield the PGN text of a user's games, or everyone's, archived games first"""
+    archived = export_archive_query(user_id, statuses)
+    if archived is not None:
+        yield from iter_pgn(archived, batch_size)
+    yield from iter_pgn(export_query(user_id, statuses), batch_size)
+
+
+def iter_pgn(query, batch_size=500):
+    """Yield the PGN text of every game selected by an export_query() or export_archive_query()"""
+    for row, uci_moves in iter_game_moves(query, batch_size):
+        try:
+            yield format_pgn(row, uci_moves)
+        except ValueError as e:
+            logger.warning("Skipping game %s in PGN export: %s", row.id, e)
+
+
+def iter_game_moves(query, batch_size=500):
+    """Yield (row, UCI moves) for every game a query selects.
+
+    The query must select the id, moves and ply_count columns, or the id
+    and packed_moves of archived games. Games stream from a server-side
+    cursor in batches; the moves of each batch are read with one ordered
+    query and merged with their games, so memory use does not grow with
+    the number of games.
+    """
+    rows = db.session.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+    for batch in rows.partitions():
+        if 'packed_moves' in batch[0]._fields:
+            for row in batch:
+                yield row, unpack_moves(row.packed_moves)
+            continue
+        moves = batch_moves([row.id for row in batch if row.ply_count])
+        for row in batch:
+            if row.ply_count:
+                yield row, moves.get(row.id, [])
+            else:
+                yield row, (row.moves or '').split()  # Legacy games not migrated yet
+
+
+def batch_moves(game_ids):
+    """Return {game id: UCI moves in order} for the given games"""
+    moves = {}
+    if not game_ids:
+        return moves
+    query = select(GameMove.game_id, GameMove.uci).where(
+        GameMove.game_id.in_(game_ids)
+    ).order_by(GameMove.game_id, GameMove.ply)
+    for game_id, move_uci in db.session.execute(query):
+        moves.setdefault(game_id, []).append(move_uci)
+    return moves
+
+
+def format_pgn(row, uci_moves):
+    """Return one exported game as PGN text, ending with a blank line"""
+    result = row.result if row.result in PGN_RESULTS else '*'
+    headers = [
+        ('Event', PGN_EVENT),
+        ('Site', f'Game {row.id}'),
+        ('Date', row.created_at.strftime('%Y.%m.%d') if row.created_at else '????.??.??'),
+        ('Round', '-'),
+        ('White', row.white),
+        ('Black', row.black or '?'),
+        ('Result', result),
+    ]
+    if row.time_control:
+        minutes, increment = row.time_control.split('+')
+        headers.append(('TimeControl', f'{int(minutes) * 60}+{increment}'))
+
+    board = chess.Board()
+    movetext = board.variation_san([chess.Move.from_uci(move) for move in uci_moves])
+    lines = [f'[{name} "{_escape(value)}"]' for name, value in headers]
+    lines.append('')
+    lines.extend(textwrap.wrap(f'{movetext} {result}'.strip(), width=79))
+    return '\n'.join(lines) + '\n\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+# Import
+
+def split_pgn(lines, games_per_chunk=200):
+    """Group the lines of a PGN stream into chunks of raw game texts"""
+    chunk, game, in_movetext = [], [], False
+    for line in lines:
+        if line.startswith('[') and in_movetext:
+            chunk.append(''.join(game))
+            game, in_movetext = [], False
+            if len(chunk) >= games_per_chunk:
+                yield chunk
+                chunk = []
+        elif line.strip() and not line.startswith('['):
+            in_movetext = True
+        game.append(line)
+    if any(line.strip() for line in game):
+        chunk.append(''.join(game))
+    if chunk:
+        yield chunk
+
+
+class MoveCollector(chess.pgn.BaseVisitor):
+    """Collects the headers and mainline UCI moves of a game without building a move tree"""
+
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.moves = []
+        self.errors = []
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self.moves.append(move.uci())
+
+    def handle_error(self, error):
+        self.errors.append(error)
+
+    def result(self):
+        return self
+
+
+def parse_games(texts):
+    """Parse raw PGN game texts into plain tuples; runs in worker processes.
+
+    Returns (games, skipped) where each game is (white, black, result,
+    date, time control, UCI moves). Games with errors or a custom start
+    position are skipped.
+    """
+    games, skipped = [], 0
+    for text in texts:
+        game = chess.pgn.read_game(io.StringIO(text), Visitor=MoveCollector)
+        if game is None or game.errors or 'FEN' in game.headers:
+            skipped += 1
+            continue
+        headers = game.headers
+        moves = game.moves
+        games.append((
+            headers.get('White', '?'),
+            headers.get('Black', '?'),
+            headers.get('Result', '*'),
+            headers.get('Date', ''),
+            headers.get('TimeControl', ''),
+            moves
+        ))
+    return games, skipped
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y.%m.%d')
+    except ValueError:
+        return None
+
+
+def _parse_time_control(value):
+    """Convert a PGN TimeControl such as 300+3 into our 5+3 form, if it fits"""
+    try:
+        seconds, increment = value.split('+')
+        seconds, increment = int(seconds), int(increment)
+    except ValueError:
+        return None
+    if seconds % 60 or not 0 < seconds // 60 < 1000 or increment >= 100:
+        return None
+    return f'{seconds // 60}+{increment}'
+
+
+def _player_ids(names):
+    """Map player names to user ids, creating placeholder users for new names"""
+    names = {name[:80] for name in names}
+    ids = dict(db.session.execute(select(User.username, User.id).where(User.username.in_(names))).all())
+    missing = sorted(names - ids.keys())
+    if missing:
+        now = datetime.utcnow()
+        db.session.execute(insert(User), [{
+            'username': name,
+            'email': f'{name}@{IMPORTED_EMAIL_DOMAIN}',
+            'password_hash': UNUSABLE_PASSWORD,
+            'created_at': now
+        } for name in missing])
+        ids.update(db.session.execute(select(User.username, User.id).where(User.username.in_(missing))).all())
+    return ids
+
+
+def insert_games(games):
+    """Bulk insert parsed games and their moves in one transaction, returning the count"""
+    if not games:
+        return 0
+    players = _player_ids({game[0] for game in games} | {game[1] for game in games})
+    now = datetime.utcnow()
+    rows = []
+    for white, black, result, date, time_control, moves in games:
+        played = _parse_date(date) or now
+        rows.append({
+            'player_white_id': players[white[:80]],
+            'player_black_id': players[black[:80]],
+            'moves': None,
+            'ply_count': len(moves),
+            'status': 'finished',
+            'result': result if result in PGN_RESULTS else '*',
+            'time_control': _parse_time_control(time_control),
+            'created_at': played,
+            'updated_at': played
+        })
+    game_ids = db.session.scalars(
+        insert(Game).returning(Game.id, sort_by_parameter_order=True), rows
+    ).all()
+    move_rows = [
+        {'game_id': game_id, 'ply': ply, 'uci': move_uci, 'created_at': now}
+        for game_id, game in zip(game_ids, games)
+        for ply, move_uci in enumerate(game[5], start=1)
+    ]
+    if move_rows:
+        db.session.execute(insert(GameMove), move_rows)
+    db.session.commit()
+    return len(game_ids)
+
+
+def import_pgn(stream, workers=None, games_per_chunk=200, progress=None):
+    """Import every game of a PGN stream, parsing chunks in a process pool.
+
+    Only a few chunks are in flight at a time, so archives of any size are
+    read with bounded memory. Each parsed chunk is inserted with one bulk
+    insert per table. Returns (imported, skipped).
+    """
+    workers = workers or os.cpu_count() or 1
+    imported = skipped = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        chunks = split_pgn(stream, games_per_chunk)
+        while True:
+            for texts in chunks:
+                pending.append(pool.submit(parse_games, texts))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            games, bad = pending.pop(0).result()
+            imported += insert_games(games)
+            skipped += bad
+            if progress:
+                progress(imported, skipped)
+    return imported, skipped
@@ -0,0 +1,76 @@
+import chess
+import chess.polyglot
+
+# Reasons a game ends without a player's action, and the draws a player may claim
+CHECKMATE = 'checkmate'
+STALEMATE = 'stalemate'
+INSUFFICIENT_MATERIAL = 'insufficient_material'
+SEVENTYFIVE_MOVES = 'seventyfive_moves'
+FIVEFOLD_REPETITION = 'fivefold_repetition'
+THREEFOLD_REPETITION = 'threefold_repetition'
+FIFTY_MOVES = 'fifty_moves'
+
+
+class PositionTracker:
+    """Occurrence counts of the positions of a game, updated one ply at a time.
+
+    Positions are counted by Zobrist hash. A pawn move or capture makes
+    every earlier position unreachable, so the counts start over whenever
+    the halfmove clock resets; each ply then costs one hash and one dict
+    update, however long the game, instead of python-chess walking the
+    move stack back for every repetition check.
+    """
+    __slots__ = ('ply', 'key', 'counts')
+
+    def __init__(self, board):
+        # Replay only the moves since the last pawn move or capture
+        tail = board.copy(stack=board.halfmove_clock)
+        moves = tail.move_stack
+        position = tail.root()
+        self.counts = {}
+        self._count(position)
+        for move in moves:
+            position.push(move)
+            self._count(position)
+        self.ply = board.ply()
+
+    def _count(self, board):
+        self.key = chess.polyglot.zobrist_hash(board)
+        self.counts[self.key] = self.counts.get(self.key, 0) + 1
+
+    def push(self, board):
+        """Count the position after the move just pushed onto the board"""
+        if board.halfmove_clock == 0:
+            self.counts.clear()
+        self._count(board)
+        self.ply = board.ply()
+
+    def repetitions(self):
+        """Return how often the current position has occurred"""
+        return self.counts.get(self.key, 0)
+
+    def outcome(self, board, legal_moves, check):
+        """Return (result, reason) if the game is over, else None.
+
+        ``legal_moves`` and ``check`` describe the current position; callers
+        already have them for the broadcast, so nothing is generated twice.
+        """
+        if not legal_moves:
+            if check:
+                return ('1-0' if board.turn == chess.BLACK else '0-1'), CHECKMATE
+            return '1/2-1/2', STALEMATE
+        if board.is_insufficient_material():
+            return '1/2-1/2', INSUFFICIENT_MATERIAL
+        if board.halfmove_clock >= 150:
+            return '1/2-1/2', SEVENTYFIVE_MOVES
+        if self.repetitions() >= 5:
+            return '1/2-1/2', FIVEFOLD_REPETITION
+        return None
+
+    def claimable_draw(self, board):
+        """Return the reason the side to move may claim a draw now, or None"""
+        if self.repetitions() >= 3:
+            return THREEFOLD_REPETITION
+        if board.halfmove_clock >= 100:
+            return FIFTY_MOVES
+        return None
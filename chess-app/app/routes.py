@@ -1,10 +1,41 @@
-from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
-from .models import db, User, Game, WaitingQueue
+from flask import Blueprint, render_template, request, jsonify, session, redirect, url_for, current_app, Response, abort, stream_with_context
+from .models import db, User, ArchivedGame, Game, Tournament, TournamentPlayer
+from .auth import password_hasher, user_cache, HasherBusy
+from .metrics import metrics
+from .persistence import move_store
+from .pgn import export_games
+from .explorer import explore
+from .matchmaking import matchmaker, create_match, valid_time_control, QueueEntry, DEFAULT_TIME_CONTROL
+from .bots import valid_level
+from .engine import DEFAULT_LEVEL
+from .tournaments import KINDS, SWISS, ARENA, tournament_director
 from functools import wraps
+from datetime import datetime
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from itertools import islice
+import base64
+import binascii
+import heapq
+import random
+import chess
 
 main = Blueprint('main', __name__)
 
+GAME_STATUSES = {'waiting', 'active', 'finished'}
+MY_GAMES_PAGE_SIZE = 20
+MY_GAMES_MAX_PAGE_SIZE = 100
+MAX_TOURNAMENT_ROUNDS = 50
+MAX_ARENA_MINUTES = 24 * 60
+STANDINGS_PAGE_SIZE = 100
+STANDINGS_MAX_PAGE_SIZE = 1000
+
+# Tournaments that were running before a restart carry on once this worker serves a request
+@main.before_app_request
+def resume_tournaments():
+    tournament_director.resume()
+
 def login_required(f):
     """Decorator to require login for routes"""
     @wraps(f)
@@ -21,7 +52,7 @@ def index():
     user_id = session.get('user_id')
     user = None
     if user_id:
-        user = User.query.get(user_id)
+        user = user_cache.get(user_id)
     return render_template('index.html', user=user)
 
 # GAME PAGE
@@ -29,13 +60,15 @@ def index():
 @login_required
 def game(game_id):
     user_id = session.get('user_id')
-    game = Game.query.get_or_404(game_id)
-    
-    # Check if user is part of this game
-    if user_id not in [game.player_white_id, game.player_black_id]:
-        return jsonify({'error': 'Access denied'}), 403
+    game = move_store.load_game(game_id)
+    if game is None:
+        abort(404)
     
-    return render_template('game.html', game=game, user_id=user_id)
+    # Users who are not playing watch the game read-only
+    return render_template('game.html', game=game, user_id=user_id,
+                           white_player=user_cache.get(game.player_white_id),
+                           black_player=user_cache.get(game.player_black_id),
+                           moves=list(move_store.iter_moves(game)))
 
 # SIGNUP
 @main.route('/signup', methods=['POST'])
@@ -56,9 +89,14 @@ def signup():
     if User.query.filter((User.username == username) | (User.email == email)).first():
         return jsonify({'error': 'Username or email already exists'}), 400
     
+    # Hashing runs in a process pool; when it is saturated, ask the client to retry
+    try:
+        hashed_password = password_hasher.hash(password)
+    except HasherBusy:
+        return busy_response()
+
     try:
         # Create new user
-        hashed_password = generate_password_hash(password)
         new_user = User(username=username, email=email, password_hash=hashed_password)
         db.session.add(new_user)
         db.session.commit()
@@ -84,7 +122,11 @@ def login():
         return jsonify({'error': 'Missing required fields'}), 400
     
     user = User.query.filter_by(username=username).first()
-    if user and check_password_hash(user.password_hash, password):
+    try:
+        valid = user is not None and password_hasher.check(user.password_hash, password)
+    except HasherBusy:
+        return busy_response()
+    if valid:
         session['user_id'] = user.id
         return jsonify({
             'message': 'Login successful',
@@ -93,10 +135,18 @@ def login():
     else:
         return jsonify({'error': 'Invalid credentials'}), 401
     
+def busy_response():
+    """Answer 503 while the password hash pool is full"""
+    response = jsonify({'error': 'Too many login attempts right now, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 # LOGOUT
 @main.route('/logout', methods=['POST'])
 def logout():
-    session.pop('user_id', None)
+    user_id = session.pop('user_id', None)
+    if user_id:
+        matchmaker.leave(user_id)
     return jsonify({'message': 'Logged out successfully'}), 200
 
 # JOIN MATCHMAKING QUEUE
@@ -104,27 +154,29 @@ def logout():
 @login_required
 def find_game():
     user_id = session.get('user_id')
-    
+    data = request.get_json(silent=True) or {}
+    time_control = data.get('time_control', DEFAULT_TIME_CONTROL)
+
+    if not valid_time_control(time_control):
+        return jsonify({'error': 'Invalid time control'}), 400
+
     # Check if user is already in queue
-    existing_queue = WaitingQueue.query.filter_by(user_id=user_id).first()
-    if existing_queue:
+    if user_id in matchmaker:
         return jsonify({'error': 'Already in queue'}), 400
-    
-    # Check if there's someone waiting
-    waiting_player = WaitingQueue.query.filter(WaitingQueue.user_id != user_id).first()
-    
+
+    rating = db.session.query(User.rating).filter_by(id=user_id).scalar()
+    matchmaker.ensure_sweeper(current_app._get_current_object())
+
+    # Pairs with a waiting player atomically, or queues this one
+    waiting_player = matchmaker.join(user_id, rating, time_control)
+
     if waiting_player:
-        # Create game with waiting player
-        game = Game(
-            player_white_id=waiting_player.user_id,
-            player_black_id=user_id,
-            status='active'
-        )
-        db.session.add(game)
-        
-        # Remove from queue
-        db.session.delete(waiting_player)
-        db.session.commit()
+        # Create game with waiting player, who is told over their socket
+        try:
+            game = create_match(waiting_player, QueueEntry(user_id, rating, time_control), notify=(waiting_player,))
+        except Exception:
+            matchmaker.requeue(waiting_player)
+            return jsonify({'error': 'Failed to create game'}), 500
         
         return jsonify({
             'message': 'Game found!',
@@ -132,19 +184,66 @@ def find_game():
             'color': 'black'
         }), 200
     else:
-        # Add to queue
-        queue_entry = WaitingQueue(user_id=user_id)
-        db.session.add(queue_entry)
-        db.session.commit()
-        
         return jsonify({'message': 'Added to queue, waiting for opponent...'}), 200
 
+# PLAY AGAINST THE COMPUTER
+@main.route('/play-computer', methods=['POST'])
+@login_required
+def play_computer():
+    from .sockets import bot_player
+
+    user_id = session.get('user_id')
+    data = request.get_json(silent=True) or {}
+    level = data.get('level', DEFAULT_LEVEL)
+    color = data.get('color') or random.choice(('white', 'black'))
+    time_control = data.get('time_control')  # Untimed unless given
+
+    if not valid_level(level):
+        return jsonify({'error': 'Invalid level'}), 400
+    if color not in ('white', 'black'):
+        return jsonify({'error': 'Invalid color'}), 400
+    if time_control is not None and not valid_time_control(time_control):
+        return jsonify({'error': 'Invalid time control'}), 400
+
+    # Backpressure: refuse new bot games while the engine pool is saturated
+    if bot_player.busy():
+        return jsonify({'error': 'The computer is busy, try again shortly'}), 503
+
+    player = QueueEntry(user_id, None, time_control)
+    computer = QueueEntry(bot_player.bot_id(level), None, time_control)
+    try:
+        if color == 'white':
+            game = create_match(player, computer)
+        else:
+            game = create_match(computer, player)
+    except Exception:
+        return jsonify({'error': 'Failed to create game'}), 500
+
+    # The computer opens when it plays white
+    bot_player.request(game, chess.Board())
+
+    return jsonify({
+        'message': 'Game started',
+        'game_id': game.id,
+        'color': color,
+        'level': level
+    }), 200
+
+# LEAVE MATCHMAKING QUEUE
+@main.route('/leave-queue', methods=['POST'])
+@login_required
+def leave_queue():
+    if not matchmaker.leave(session.get('user_id')):
+        return jsonify({'error': 'Not in queue'}), 400
+    return jsonify({'message': 'Left the queue'}), 200
+
 # GET CURRENT USER INFO
 @main.route('/user', methods=['GET'])
 @login_required
 def get_user():
-    user_id = session.get('user_id')
-    user = User.query.get(user_id)
+    user = user_cache.get(session.get('user_id'))
+    if user is None:
+        return jsonify({'error': 'User not found'}), 404
     return jsonify({
         'id': user.id,
         'username': user.username,
@@ -156,20 +255,284 @@ def get_user():
 @login_required
 def my_games():
     user_id = session.get('user_id')
-    games = Game.query.filter(
-        (Game.player_white_id == user_id) | (Game.player_black_id == user_id)
-    ).order_by(Game.updated_at.desc()).all()
+
+    try:
+        limit = min(max(int(request.args.get('limit', MY_GAMES_PAGE_SIZE)), 1), MY_GAMES_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    statuses = [status for status in request.args.get('status', '').split(',') if status]
+    if statuses and not set(statuses) <= GAME_STATUSES:
+        return jsonify({'error': 'Invalid status filter'}), 400
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+    # Live and archived games are read the same way and merged, newest first
+    pages = [history_page(Game, user_id, statuses, cursor, limit + 1)]
+    if not statuses or 'finished' in statuses:
+        pages.append(history_page(ArchivedGame, user_id, None, cursor, limit + 1))
+    games = list(islice(heapq.merge(*pages, key=history_key, reverse=True), limit + 1))
+
+    next_cursor = None
+    if len(games) > limit:
+        games = games[:limit]
+        next_cursor = encode_cursor(games[-1].updated_at, games[-1].id)
     
     games_data = []
     for game in games:
+        opponent = game.black_player if game.player_white_id == user_id else game.white_player
         games_data.append({
             'id': game.id,
             'status': game.status,
             'result': game.result,
+            'time_control': game.time_control,
             'created_at': game.created_at.isoformat(),
             'updated_at': game.updated_at.isoformat(),
             'my_color': 'white' if game.player_white_id == user_id else 'black',
-            'opponent': game.black_player.username if game.player_white_id == user_id else game.white_player.username
+            'opponent': opponent.username if opponent else None
         })
     
-    return jsonify({'games': games_data})
\ No newline at end of file
+    return jsonify({'games': games_data, 'next_cursor': next_cursor})
+
+# EXPORT USER'S GAMES AS PGN
+@main.route('/my-games/export.pgn', methods=['GET'])
+@login_required
+def export_my_games():
+    user_id = session.get('user_id')
+    statuses = [status for status in request.args.get('status', '').split(',') if status]
+    if not set(statuses) <= GAME_STATUSES:
+        return jsonify({'error': 'Invalid status filter'}), 400
+
+    # Games are streamed as they are read, never held in memory all at once
+    pgn = stream_with_context(export_games(user_id, statuses))
+    return Response(pgn, mimetype='application/x-chess-pgn', headers={
+        'Content-Disposition': 'attachment; filename="my-games.pgn"'
+    })
+
+# OPENING EXPLORER
+@main.route('/explorer', methods=['GET'])
+def opening_explorer():
+    fen = request.args.get('fen', chess.STARTING_FEN)
+    try:
+        board = chess.Board(fen)
+    except ValueError:
+        return jsonify({'error': 'Invalid FEN'}), 400
+    return jsonify(explore(board))
+
+# LIST TOURNAMENTS
+@main.route('/tournaments', methods=['GET'])
+def list_tournaments():
+    players = db.session.query(
+        TournamentPlayer.tournament_id, func.count().label('players')
+    ).filter(TournamentPlayer.withdrawn.is_(False)).group_by(TournamentPlayer.tournament_id).subquery()
+    rows = db.session.query(Tournament, players.c.players).outerjoin(
+        players, players.c.tournament_id == Tournament.id
+    ).filter(Tournament.status.in_(('open', 'running'))).order_by(Tournament.created_at.desc()).limit(50).all()
+    return jsonify({'tournaments': [tournament_data(tournament, count or 0) for tournament, count in rows]})
+
+# CREATE TOURNAMENT
+@main.route('/tournaments', methods=['POST'])
+@login_required
+def create_tournament():
+    user_id = session.get('user_id')
+    data = request.get_json(silent=True) or {}
+    name = data.get('name')
+    kind = data.get('kind', SWISS)
+    time_control = data.get('time_control', DEFAULT_TIME_CONTROL)
+    rounds = data.get('rounds', 5)
+    duration = data.get('duration_minutes', 60)
+
+    if not isinstance(name, str) or not 0 < len(name.strip()) <= 80:
+        return jsonify({'error': 'Invalid name'}), 400
+    if kind not in KINDS:
+        return jsonify({'error': 'Invalid tournament kind'}), 400
+    if not valid_time_control(time_control):
+        return jsonify({'error': 'Invalid time control'}), 400
+    if kind == SWISS and not (isinstance(rounds, int) and 0 < rounds <= MAX_TOURNAMENT_ROUNDS):
+        return jsonify({'error': 'Invalid number of rounds'}), 400
+    if kind == ARENA and not (isinstance(duration, int) and 0 < duration <= MAX_ARENA_MINUTES):
+        return jsonify({'error': 'Invalid duration'}), 400
+
+    tournament = Tournament(
+        name=name.strip(),
+        kind=kind,
+        time_control=time_control,
+        rounds=rounds if kind == SWISS else None,
+        duration_minutes=duration if kind == ARENA else None,
+        created_by=user_id
+    )
+    db.session.add(tournament)
+    db.session.commit()
+    return jsonify({'message': 'Tournament created', 'tournament': tournament_data(tournament, 0)}), 201
+
+# TOURNAMENT DETAILS AND STANDINGS
+@main.route('/tournaments/<int:tournament_id>', methods=['GET'])
+def tournament_standings(tournament_id):
+    tournament = db.session.get(Tournament, tournament_id)
+    if tournament is None:
+        return jsonify({'error': 'Tournament not found'}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', STANDINGS_PAGE_SIZE)), 1), STANDINGS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    # Scores are recounted by the tournament director every few seconds
+    rows = db.session.query(TournamentPlayer, User.username).join(
+        User, User.id == TournamentPlayer.user_id
+    ).filter(TournamentPlayer.tournament_id == tournament_id).order_by(
+        TournamentPlayer.score.desc(), TournamentPlayer.rating.desc(), TournamentPlayer.user_id
+    ).limit(limit).all()
+    count = db.session.query(func.count()).filter(
+        TournamentPlayer.tournament_id == tournament_id, TournamentPlayer.withdrawn.is_(False)
+    ).scalar()
+    standings = [{
+        'rank': rank,
+        'user_id': player.user_id,
+        'username': username,
+        'rating': player.rating,
+        'score': player.score / 2,
+        'games': player.games,
+        'byes': player.byes,
+        'withdrawn': player.withdrawn
+    } for rank, (player, username) in enumerate(rows, start=1)]
+    return jsonify({'tournament': tournament_data(tournament, count), 'standings': standings})
+
+# JOIN TOURNAMENT
+@main.route('/tournaments/<int:tournament_id>/join', methods=['POST'])
+@login_required
+def join_tournament(tournament_id):
+    user_id = session.get('user_id')
+    tournament = db.session.get(Tournament, tournament_id)
+    if tournament is None:
+        return jsonify({'error': 'Tournament not found'}), 404
+    if tournament.status == 'finished':
+        return jsonify({'error': 'Tournament is over'}), 400
+
+    # Late entrants start on zero and are paired from the next round
+    player = db.session.get(TournamentPlayer, (tournament_id, user_id))
+    if player is None:
+        db.session.add(TournamentPlayer(tournament_id=tournament_id, user_id=user_id,
+                                        rating=user_cache.get(user_id).rating))
+    else:
+        player.withdrawn = False
+        player.joined_at = datetime.utcnow()  # Games missed before rejoining no longer count against them
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()  # Joined twice at once
+    return jsonify({'message': 'Joined tournament', 'tournament_id': tournament_id}), 200
+
+# LEAVE TOURNAMENT
+@main.route('/tournaments/<int:tournament_id>/leave', methods=['POST'])
+@login_required
+def leave_tournament(tournament_id):
+    user_id = session.get('user_id')
+    player = db.session.get(TournamentPlayer, (tournament_id, user_id))
+    if player is None:
+        return jsonify({'error': 'Not in this tournament'}), 400
+
+    # Withdrawn players keep their score but are not paired again
+    player.withdrawn = True
+    db.session.commit()
+    return jsonify({'message': 'Left tournament', 'tournament_id': tournament_id}), 200
+
+# START TOURNAMENT
+@main.route('/tournaments/<int:tournament_id>/start', methods=['POST'])
+@login_required
+def start_tournament(tournament_id):
+    user_id = session.get('user_id')
+    tournament = db.session.get(Tournament, tournament_id)
+    if tournament is None:
+        return jsonify({'error': 'Tournament not found'}), 404
+    if tournament.created_by != user_id:
+        return jsonify({'error': 'Only the organiser can start the tournament'}), 403
+    if tournament.status != 'open':
+        return jsonify({'error': 'Tournament already started'}), 400
+    players = db.session.query(func.count()).filter(
+        TournamentPlayer.tournament_id == tournament_id, TournamentPlayer.withdrawn.is_(False)
+    ).scalar()
+    if players < 2:
+        return jsonify({'error': 'At least two players are needed'}), 400
+
+    # Pairs the first round now; later rounds are paired by the director
+    if not tournament_director.begin(tournament):
+        return jsonify({'error': 'Tournament already started'}), 400
+    return jsonify({'message': 'Tournament started', 'tournament': tournament_data(tournament, players)}), 200
+
+def tournament_data(tournament, players):
+    """Return the public fields of a tournament"""
+    return {
+        'id': tournament.id,
+        'name': tournament.name,
+        'kind': tournament.kind,
+        'status': tournament.status,
+        'time_control': tournament.time_control,
+        'rounds': tournament.rounds,
+        'duration_minutes': tournament.duration_minutes,
+        'current_round': tournament.current_round,
+        'players': players,
+        'started_at': tournament.started_at.isoformat() if tournament.started_at else None,
+        'ends_at': tournament.ends_at.isoformat() if tournament.ends_at else None
+    }
+
+def history_page(model, user_id, statuses, cursor, limit):
+    """Return a user's games from Game or ArchivedGame after cursor, newest first.
+
+    Games as white and games as black are read by separate queries, each
+    walking its own (player, updated_at, id) index in order and stopping
+    after limit rows, and merged.
+    """
+    sides = [
+        model.player_white_id == user_id,
+        (model.player_black_id == user_id) & (model.player_white_id != user_id)
+    ]
+    pages = [history_side(model, side, statuses, cursor, limit) for side in sides]
+    return list(islice(heapq.merge(*pages, key=history_key, reverse=True), limit))
+
+def history_side(model, side, statuses, cursor, limit):
+    """Return the games matching side after cursor, newest first"""
+    query = model.query.filter(side)
+    if statuses:
+        query = query.filter(model.status.in_(statuses))
+    if cursor:
+        # Continue strictly after the last game of the previous page
+        query = query.filter(tuple_(model.updated_at, model.id) < tuple_(*cursor))
+
+    # Load both players with the games in one query instead of one per row
+    return query.options(
+        joinedload(model.white_player).load_only(User.username),
+        joinedload(model.black_player).load_only(User.username)
+    ).order_by(model.updated_at.desc(), model.id.desc()).limit(limit).all()
+
+def history_key(game):
+    return (game.updated_at, game.id)
+
+def encode_cursor(updated_at, game_id):
+    """Encode the position after a game in the history as an opaque cursor"""
+    raw = f"{updated_at.isoformat()}|{game_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor, raising ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        updated_at, game_id = raw.split('|')
+        return datetime.fromisoformat(updated_at), int(game_id)
+    except (UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError('Invalid cursor') from e
+
+# BOARD CACHE STATS
+@main.route('/stats/board-cache', methods=['GET'])
+def board_cache_stats():
+    from .sockets import board_cache
+    return jsonify(board_cache.stats())
+
+# PROMETHEUS METRICS
+@main.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
\ No newline at end of file
@@ -0,0 +1,62 @@
+import chess
+from .models import db, GameSnapshot
+
+# Take a snapshot every this many plies unless configured otherwise
+DEFAULT_SNAPSHOT_INTERVAL = 20
+
+
+def snapshot_fields(board):
+    """Return the (fen, history) pair a snapshot of the board stores.
+
+    Only the moves since the last pawn move or capture are kept alongside
+    the FEN, which is all repetition detection needs to look at.
+    """
+    tail = board.copy(stack=board.halfmove_clock)
+    return tail.root().fen(), ' '.join(move.uci() for move in tail.move_stack)
+
+
+def save_snapshot(game, board):
+    """Store the board's position for a game, replacing any older snapshot"""
+    return store_snapshot(game.id, game.ply_count, *snapshot_fields(board))
+
+
+def store_snapshot(game_id, ply, fen, history):
+    """Insert or update the snapshot row of a game"""
+    snapshot = db.session.get(GameSnapshot, game_id)
+    if snapshot is None:
+        snapshot = GameSnapshot(game_id=game_id)
+        db.session.add(snapshot)
+    snapshot.ply = ply
+    snapshot.fen = fen
+    snapshot.history = history
+    return snapshot
+
+
+def snapshot_due(ply, interval=DEFAULT_SNAPSHOT_INTERVAL):
+    """Return True if a game that just reached ply should be snapshotted"""
+    return bool(interval and ply and ply % interval == 0)
+
+
+def maybe_snapshot(game, board, interval=DEFAULT_SNAPSHOT_INTERVAL):
+    """Snapshot the game if it just reached a multiple of the interval"""
+    if snapshot_due(game.ply_count, interval):
+        return save_snapshot(game, board)
+    return None
+
+
+def load_board(game):
+    """Rebuild a game's board from its latest snapshot plus the moves after it"""
+    snapshot = db.session.get(GameSnapshot, game.id) if game.ply_count else None
+    if snapshot is None or snapshot.ply > game.ply_count:
+        board = chess.Board()
+        start_ply = 0
+    else:
+        board = chess.Board(snapshot.fen)
+        for move_uci in snapshot.history.split():
+            board.push_uci(move_uci)
+        start_ply = snapshot.ply
+
+    for move_uci in game.iter_moves(start_ply=start_ply):
+        if move_uci:  # Ensure move is not empty
+            board.push_uci(move_uci)
+    return board
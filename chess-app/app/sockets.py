@@ -1,31 +1,365 @@
+import logging
+import time
+from datetime import datetime
+from functools import wraps
 import chess
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from flask_socketio import emit, join_room, leave_room
 from flask import session, request
 from . import socketio
-from .models import db, Game, User
+from .auth import user_cache
+from .board_cache import BoardCache
+from .bots import BotPlayer
+from .clocks import ClockScheduler, apply_move, deadline, flag, remaining_ms, stop_clocks
+from .explorer import explorer_indexer
+from .archive import game_archiver
+from .metrics import metrics
+from .models import db
+from .persistence import move_store
+from .spectators import spectator_feed, spectator_room
 
-# In-memory board objects for active games
-active_boards = {}
-# Track connected users per room
-room_users = {}
+logger = logging.getLogger(__name__)
+
+# In-memory boards for active games and the sockets connected to each room
+board_cache = BoardCache(move_store.load_board)
+
+EVENT_SECONDS = metrics.histogram('chess_socket_event_seconds', 'Time spent handling Socket.IO events')
+COMMIT_SECONDS = metrics.histogram('chess_db_commit_seconds', 'Time spent persisting accepted moves')
+BROADCAST_SECONDS = metrics.histogram('chess_broadcast_seconds', 'Time spent emitting a move to its room')
+MOVES = metrics.counter('chess_moves_total', 'Moves accepted')
+REJECTED_MOVES = metrics.counter('chess_rejected_moves_total', 'Moves rejected, by reason')
+FLAG_FALLS = metrics.counter('chess_flag_falls_total', 'Games lost on time')
+CONNECTED_SIDS = metrics.gauge('chess_connected_sids', 'Sockets connected to this worker')
+metrics.callback('chess_active_rooms', 'Game rooms with connected sockets on this worker',
+                 lambda: board_cache.stats()['rooms'])
+metrics.callback('chess_cached_boards', 'Boards held in the board cache', lambda: len(board_cache))
+metrics.callback('chess_board_cache_events_total', 'Board cache lookups and evictions',
+                 lambda: {event: board_cache.stats()[event] for event in ('hits', 'misses', 'evictions')},
+                 type='counter', label='event')
+metrics.callback('chess_armed_clocks', 'Timed games with a scheduled flag check', lambda: len(clock_scheduler))
+metrics.callback('chess_engine_pending_searches', 'Computer moves being searched', lambda: len(bot_player))
+
+def instrumented(event):
+    """Time a Socket.IO handler and profile a sampled fraction of its calls"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with metrics.timed(EVENT_SECONDS, event=event), metrics.profiled(event):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def color_room(room, color):
+    """Return the sub-room holding only the sockets playing the given color"""
+    return f"{room}_{color}"
+
+def user_room(user_id):
+    """Return the room holding every socket of a logged in user"""
+    return f"user_{user_id}"
+
+def process_move(user_id, game_id, move_uci, reply=emit):
+    """Validate, persist and broadcast a move; the caller holds the game's lock.
+
+    Errors go to the mover through ``reply(event, data)``, which defaults to
+    the socket that sent the move.
+    """
+    game = move_store.load_game(game_id)
+    if not game:
+        reply('error', {'message': 'Game not found.'})
+        return
+
+    if game.status != 'active':
+        reply('error', {'message': 'Game is not active.'})
+        return
+
+    # Games stored before game_moves existed are moved over on their next move
+    game.migrate_legacy_moves()
+
+    # Check if it's the player's turn
+    ply = game.ply_count
+    is_white_turn = ply % 2 == 0
+    
+    if (is_white_turn and game.player_white_id != user_id) or \
+       (not is_white_turn and game.player_black_id != user_id):
+        REJECTED_MOVES.inc(reason='not_your_turn')
+        reply('error', {'message': 'Not your turn!'})
+        return
+
+    room = f"game_{game_id}"
+    try:
+        # Reconstructs the board if not in memory
+        board = board_cache.get(room, game)
+        if board.ply() != ply:
+            # Another worker moved in this game since the board was cached
+            board_cache.discard(room)
+            board = board_cache.get(room, game)
+    except ValueError:
+        logger.exception("Error replaying moves for game %s", game_id)
+        reply('error', {'message': 'Game state corrupted.'})
+        return
+
+    # The server's clock decides whether the move was made in time
+    now = datetime.utcnow()
+    mover = 'white' if is_white_turn else 'black'
+    if not apply_move(game, mover, now):
+        try:
+            end_on_time(game, board, room, now)
+        except (StaleDataError, IntegrityError):
+            db.session.rollback()
+            board_cache.discard(room)
+        return
+
+    try:
+        # Validate and make the move
+        chess_move = chess.Move.from_uci(move_uci)
+    except ValueError as e:
+        REJECTED_MOVES.inc(reason='invalid_format')
+        reply('error', {'message': f'Invalid move format: {str(e)}'})
+        return
+
+    if chess_move not in board.legal_moves:
+        REJECTED_MOVES.inc(reason='illegal')
+        reply('error', {'message': 'Illegal move.'})
+        return
+
+    try:
+        board.push(chess_move)
+        board_cache.touch(room)
+
+        # Check for game end conditions. The legal moves are the ones sent to
+        # the side to move, and repetitions come from the tracker's counts,
+        # so nothing here walks the move stack
+        legal_moves = board_cache.legal_moves(room, board)
+        check = board.is_check()
+        tracker = board_cache.tracker(room, board)
+        outcome = tracker.outcome(board, legal_moves, check)
+        reason = None
+        if outcome:
+            game.status = 'finished'
+            game.result, reason = outcome
+
+        # Moving declines the opponent's draw offer; an offer made by the
+        # mover stands for the opponent to answer
+        declined = game.draw_offer is not None and game.draw_offer != mover
+        if declined or game.status != 'active':
+            game.draw_offer = None
+
+        # Commits, or journals in write-behind mode. The ply_count version
+        # check rejects the commit if another worker stored a move for this
+        # game after we read it
+        with metrics.timed(COMMIT_SECONDS):
+            move_store.persist_move(game, board, move_uci, now)
+    except (StaleDataError, IntegrityError):
+        db.session.rollback()
+        board_cache.discard(room)
+        REJECTED_MOVES.inc(reason='conflict')
+        reply('move_rejected', {
+            'game_id': game_id,
+            'move': move_uci,
+            'message': 'The game was updated by another move.'
+        })
+        return
+    except Exception:
+        db.session.rollback()
+        board_cache.discard(room)
+        logger.exception("Error handling move in game %s", game_id)
+        reply('error', {'message': 'Error processing move.'})
+        return
+
+    # Broadcast a compact, numbered delta to all players in the room;
+    # clients apply the move locally and resync if they miss a ply
+    MOVES.inc()
+    turn = 'white' if board.turn else 'black'
+    update = {
+        'game_id': game_id,
+        'ply': ply + 1,
+        'move': move_uci,
+        'turn': turn,
+        'status': game.status,
+        'result': game.result,
+        'check': check,
+        'reason': reason,
+        'clocks': remaining_ms(game, now)
+    }
+    if game.status == 'active':
+        clock_scheduler.arm(game)
+    else:
+        clock_scheduler.cancel(game.id)
+        explorer_indexer.start()
+        game_archiver.start()
+    with metrics.timed(BROADCAST_SECONDS):
+        socketio.emit('move_made', update, to=room)
+        if declined:
+            socketio.emit('draw_declined', {'game_id': game_id, 'by': mover}, to=room)
+
+        # Only the side to move needs the legal moves, and whether it may claim a draw
+        if game.status == 'active':
+            socketio.emit('legal_moves', {
+                'game_id': game_id,
+                'ply': ply + 1,
+                'moves': legal_moves,
+                'draw_claim': tracker.claimable_draw(board)
+            }, to=color_room(room, turn))
+
+    # Spectators get the latest position from a background flush, off this path
+    spectator_feed.publish(room, dict(update, fen=board.fen()))
+
+    # In games against the computer, its reply is searched in the engine pool
+    bot_player.request(game, board)
+
+    logger.debug("Move made in game %s: %s", game_id, move_uci)
+
+def finish_game(game, room, now, reason):
+    """Store a game that ended between moves and announce it to players and spectators"""
+    with metrics.timed(COMMIT_SECONDS):
+        move_store.persist_game(game, now)
+    clock_scheduler.cancel(game.id)
+    explorer_indexer.start()
+    game_archiver.start()
+    game_over = {
+        'game_id': game.id,
+        'status': game.status,
+        'result': game.result,
+        'reason': reason,
+        'clocks': remaining_ms(game, now)
+    }
+    socketio.emit('game_over', game_over, to=room)
+    socketio.emit('game_over', game_over, to=spectator_room(room))
+    logger.debug("Game %s ended: %s", game.id, reason)
+
+def end_on_time(game, board, room, now):
+    """Finish a game whose side to move has run out of time and announce it"""
+    flag(game, board)
+    finish_game(game, room, now, 'timeout')
+    FLAG_FALLS.inc()
+
+DRAW_ACTIONS = ('offer', 'accept', 'decline', 'claim')
+
+def process_draw(user_id, game_id, action):
+    """Offer, accept, decline or claim a draw; the caller holds the game's lock"""
+    game = move_store.load_game(game_id)
+    if not game:
+        emit('error', {'message': 'Game not found.'})
+        return
+    if game.status != 'active':
+        emit('error', {'message': 'Game is not active.'})
+        return
+    if user_id == game.player_white_id:
+        color, opponent = 'white', 'black'
+    elif user_id == game.player_black_id:
+        color, opponent = 'black', 'white'
+    else:
+        emit('error', {'message': 'You are not playing in this game.'})
+        return
+
+    room = f"game_{game_id}"
+    now = datetime.utcnow()
+    try:
+        board = board_cache.get(room, game)
+        to_move = 'white' if board.turn else 'black'
+        clocks = remaining_ms(game, now)
+        if clocks and clocks[to_move] <= 0:
+            # The flag fell before the scheduler got to it
+            end_on_time(game, board, room, now)
+            return
+
+        if action == 'offer' and game.draw_offer == opponent:
+            action = 'accept'  # Offers crossed, so both sides agree
+        if action == 'offer':
+            if game.draw_offer != color:
+                game.draw_offer = color
+                move_store.persist_game(game, now)
+                socketio.emit('draw_offered', {'game_id': game_id, 'by': color}, to=room)
+        elif action in ('accept', 'decline'):
+            if game.draw_offer != opponent:
+                emit('error', {'message': 'There is no draw offer to answer.'})
+                return
+            game.draw_offer = None
+            if action == 'decline':
+                move_store.persist_game(game, now)
+                socketio.emit('draw_declined', {'game_id': game_id, 'by': color}, to=room)
+            else:
+                stop_clocks(game, now)
+                game.status, game.result = 'finished', '1/2-1/2'
+                finish_game(game, room, now, 'agreement')
+        else:
+            if color != to_move:
+                emit('error', {'message': 'Only the side to move can claim a draw.'})
+                return
+            reason = board_cache.tracker(room, board).claimable_draw(board)
+            if reason is None:
+                emit('error', {'message': 'No draw can be claimed in this position.'})
+                return
+            stop_clocks(game, now)
+            game.status, game.result, game.draw_offer = 'finished', '1/2-1/2', None
+            finish_game(game, room, now, reason)
+    except (StaleDataError, IntegrityError):
+        db.session.rollback()
+        board_cache.discard(room)
+        emit('error', {'message': 'The game was updated by another move, try again.'})
+    except ValueError:
+        logger.exception("Error replaying moves for game %s", game_id)
+        emit('error', {'message': 'Game state corrupted.'})
+
+def process_timeout(game_id, ply):
+    """Flag the side to move if the game is still waiting for move ply + 1.
+
+    Called by the clock scheduler once the deadline has passed; returns True
+    if the game ended on time.
+    """
+    room = f"game_{game_id}"
+    with board_cache.locked(room, sleep=socketio.sleep):
+        game = move_store.load_game(game_id)
+        if not game or game.status != 'active' or game.ply_count != ply:
+            return False
+        when = deadline(game)
+        if when is not None and when > time.time():
+            # The stored clocks were changed since this deadline was armed
+            clock_scheduler.arm(game)
+            return False
+        try:
+            end_on_time(game, board_cache.get(room, game), room, datetime.utcnow())
+        except StaleDataError:
+            # A move reached the database through another worker first
+            db.session.rollback()
+            return False
+        return True
+
+# One heap of flag-fall deadlines for every timed game in this worker
+clock_scheduler = ClockScheduler(process_timeout)
+
+def play_bot_move(bot_id, game_id, move_uci):
+    """Play a move found by the engine for a computer player"""
+    def reply(event, data):
+        logger.warning("Computer move %s in game %s was not played: %s", move_uci, game_id, data.get('message'))
+
+    with board_cache.locked(f"game_{game_id}", sleep=socketio.sleep):
+        process_move(bot_id, game_id, move_uci, reply=reply)
+
+# Searches computer moves in worker processes and plays them when found
+bot_player = BotPlayer(play_bot_move)
 
 def register_sockets(socketio):
 
     @socketio.on('connect')
     def handle_connect():
-        print(f"Client connected: {request.sid}")
+        CONNECTED_SIDS.inc()
+        logger.debug("Client connected: %s", request.sid)
+        # Lets the server push notifications such as found matches
+        user_id = session.get('user_id')
+        if user_id:
+            join_room(user_room(user_id))
 
     @socketio.on('disconnect')
     def handle_disconnect():
-        print(f"Client disconnected: {request.sid}")
-        # Clean up room_users if needed
-        for room_id in list(room_users.keys()):
-            if request.sid in room_users[room_id]:
-                room_users[room_id].discard(request.sid)
-                if not room_users[room_id]:
-                    del room_users[room_id]
+        CONNECTED_SIDS.dec()
+        logger.debug("Client disconnected: %s", request.sid)
+        # Only the rooms this socket joined need cleaning up
+        board_cache.drop_sid(request.sid)
 
     @socketio.on('join_game')
+    @instrumented('join_game')
     def handle_join_game(data):
         # Check if user is logged in
         user_id = session.get('user_id')
@@ -39,65 +373,71 @@ def register_sockets(socketio):
             return
 
         # Load game from database
-        game = Game.query.get(game_id)
+        game = move_store.load_game(game_id)
         if not game:
             emit('error', {'message': 'Game not found.'})
             return
 
-        # Check if user is part of this game
-        if user_id not in [game.player_white_id, game.player_black_id]:
-            emit('error', {'message': 'Access denied to this game.'})
-            return
+        # Anyone who is not playing joins read-only, in the spectator room
+        if user_id == game.player_white_id:
+            user_color = 'white'
+        elif user_id == game.player_black_id:
+            user_color = 'black'
+        else:
+            user_color = 'spectator'
 
         room = f"game_{game_id}"
-        join_room(room)
+        if user_color == 'spectator':
+            join_room(spectator_room(room))
+        else:
+            join_room(room)
+            join_room(color_room(room, user_color))
 
         # Track users in room
-        if room not in room_users:
-            room_users[room] = set()
-        room_users[room].add(request.sid)
+        board_cache.add_sid(room, request.sid)
 
-        # Initialize board if not present
-        if room not in active_boards:
+        # Load board, replaying moves from database if not cached
+        try:
+            board = board_cache.get(room, game)
+        except ValueError as e:
+            logger.warning("Error replaying moves for game %s: %s", game_id, e)
+            # Reset to starting position if moves are corrupted
             board = chess.Board()
-            # Replay moves from database
-            moves_list = game.get_moves_list()
-            try:
-                for move_uci in moves_list:
-                    if move_uci:  # Ensure move is not empty
-                        board.push_uci(move_uci)
-                active_boards[room] = board
-            except ValueError as e:
-                print(f"Error replaying moves for game {game_id}: {e}")
-                # Reset to starting position if moves are corrupted
-                active_boards[room] = chess.Board()
-
-        board = active_boards[room]
-        
-        # Determine user's color
-        user_color = 'white' if game.player_white_id == user_id else 'black'
-        
+            board_cache.put(room, board)
+
+        turn = 'white' if board.turn else 'black'
+        moves_list = list(move_store.iter_moves(game))
+
         # Send game state to the joining user
         emit('game_joined', {
             'game_id': game_id,
             'fen': board.fen(),
             'color': user_color,
-            'turn': 'white' if board.turn else 'black',
+            'turn': turn,
             'status': game.status,
-            'moves': game.get_moves_list(),
-            'white_player': game.white_player.username,
-            'black_player': game.black_player.username if game.black_player else 'Waiting...'
+            'ply': len(moves_list),
+            'moves': moves_list,
+            'time_control': game.time_control,
+            'clocks': remaining_ms(game, datetime.utcnow()),
+            'legal_moves': board_cache.legal_moves(room, board) if turn == user_color and game.status == 'active' else [],
+            'white_player': user_cache.username(game.player_white_id),
+            'black_player': user_cache.username(game.player_black_id, 'Waiting...')
         })
 
+        # Resume a computer opponent whose search was lost, e.g. in a restart
+        bot_player.request(game, board)
+
         # Notify other players in the room
-        emit('player_joined', {
-            'username': User.query.get(user_id).username,
-            'color': user_color
-        }, to=room, include_self=False)
+        if user_color != 'spectator':
+            emit('player_joined', {
+                'username': user_cache.username(user_id),
+                'color': user_color
+            }, to=room, include_self=False)
 
-        print(f"User {user_id} joined game {game_id}")
+        logger.debug("User %s joined game %s", user_id, game_id)
 
     @socketio.on('make_move')
+    @instrumented('make_move')
     def handle_make_move(data):
         user_id = session.get('user_id')
         if not user_id:
@@ -111,79 +451,30 @@ def register_sockets(socketio):
             emit('error', {'message': 'Game ID and move required.'})
             return
 
-        game = Game.query.get(game_id)
-        if not game:
-            emit('error', {'message': 'Game not found.'})
-            return
+        # Moves for the same game are handled one at a time in this worker
+        room = f"game_{game_id}"
+        with board_cache.locked(room, sleep=socketio.sleep):
+            process_move(user_id, game_id, move_uci)
 
-        if game.status != 'active':
-            emit('error', {'message': 'Game is not active.'})
+    def handle_draw(action, data):
+        user_id = session.get('user_id')
+        if not user_id:
+            emit('error', {'message': 'Authentication required.'})
             return
 
-        # Check if it's the player's turn
-        moves_list = game.get_moves_list()
-        is_white_turn = len(moves_list) % 2 == 0
-        
-        if (is_white_turn and game.player_white_id != user_id) or \
-           (not is_white_turn and game.player_black_id != user_id):
-            emit('error', {'message': 'Not your turn!'})
+        game_id = data.get('game_id')
+        if not game_id:
+            emit('error', {'message': 'Game ID required.'})
             return
 
         room = f"game_{game_id}"
-        board = active_boards.get(room)
-        
-        if not board:
-            # Reconstruct board if not in memory
-            board = chess.Board()
-            for move in moves_list:
-                if move:
-                    try:
-                        board.push_uci(move)
-                    except ValueError:
-                        emit('error', {'message': 'Game state corrupted.'})
-                        return
-            active_boards[room] = board
+        with board_cache.locked(room, sleep=socketio.sleep):
+            process_draw(user_id, game_id, action)
 
-        try:
-            # Validate and make the move
-            chess_move = chess.Move.from_uci(move_uci)
-            if chess_move in board.legal_moves:
-                board.push(chess_move)
-                
-                # Update database
-                game.add_move(move_uci)
-                
-                # Check for game end conditions
-                if board.is_checkmate():
-                    game.status = 'finished'
-                    game.result = '1-0' if not board.turn else '0-1'  # Opposite of current turn wins
-                elif board.is_stalemate() or board.is_insufficient_material() or board.is_seventyfive_moves() or board.is_fivefold_repetition():
-                    game.status = 'finished'
-                    game.result = '1/2-1/2'
-                
-                db.session.commit()
-
-                # Broadcast move to all players in the room
-                emit('move_made', {
-                    'move': move_uci,
-                    'fen': board.fen(),
-                    'turn': 'white' if board.turn else 'black',
-                    'status': game.status,
-                    'result': game.result,
-                    'check': board.is_check(),
-                    'legal_moves': [move.uci() for move in board.legal_moves]
-                }, to=room)
-
-                print(f"Move made in game {game_id}: {move_uci}")
-                
-            else:
-                emit('error', {'message': 'Illegal move.'})
-        
-        except ValueError as e:
-            emit('error', {'message': f'Invalid move format: {str(e)}'})
-        except Exception as e:
-            print(f"Error handling move: {e}")
-            emit('error', {'message': 'Error processing move.'})
+    # offer_draw, accept_draw, decline_draw and claim_draw
+    for action in DRAW_ACTIONS:
+        socketio.on_event(f'{action}_draw', instrumented(f'{action}_draw')(
+            lambda data, action=action: handle_draw(action, data)))
 
     @socketio.on('leave_game')
     def handle_leave_game(data):
@@ -191,17 +482,16 @@ def register_sockets(socketio):
         if game_id:
             room = f"game_{game_id}"
             leave_room(room)
+            leave_room(color_room(room, 'white'))
+            leave_room(color_room(room, 'black'))
+            leave_room(spectator_room(room))
             
             # Clean up room tracking
-            if room in room_users:
-                room_users[room].discard(request.sid)
-                if not room_users[room]:
-                    # Last player left, clean up board
-                    if room in active_boards:
-                        del active_boards[room]
-                    del room_users[room]
+            if board_cache.remove_sid(room, request.sid):
+                # Last player left, clean up board
+                board_cache.discard(room)
             
-            print(f"User left game {game_id}")
+            logger.debug("User left game %s", game_id)
 
     @socketio.on('get_legal_moves')
     def handle_get_legal_moves(data):
@@ -212,10 +502,50 @@ def register_sockets(socketio):
         
         game_id = data.get('game_id')
         room = f"game_{game_id}"
-        board = active_boards.get(room)
+        try:
+            # Rebuilds evicted boards from the database
+            board = board_cache.get(room, move_store.load_game(game_id) if game_id else None)
+        except ValueError:
+            board = None
         
         if board:
-            legal_moves = [move.uci() for move in board.legal_moves]
-            emit('legal_moves', {'moves': legal_moves})
+            emit('legal_moves', {
+                'game_id': game_id,
+                'ply': board.ply(),
+                'moves': board_cache.legal_moves(room, board)
+            })
         else:
-            emit('error', {'message': 'Game board not found.'})
\ No newline at end of file
+            emit('error', {'message': 'Game board not found.'})
+
+    @socketio.on('resync')
+    @instrumented('resync')
+    def handle_resync(data):
+        """Send the moves a client missed since the given ply"""
+        user_id = session.get('user_id')
+        if not user_id:
+            emit('error', {'message': 'Authentication required.'})
+            return
+
+        game_id = data.get('game_id')
+        game = move_store.load_game(game_id) if game_id else None
+        if not game:
+            emit('error', {'message': 'Game not found.'})
+            return
+
+        from_ply = data.get('ply')
+        # Unknown or impossible plies get the full move list
+        if not isinstance(from_ply, int) or from_ply < 0 or from_ply > game.ply_count:
+            from_ply = 0
+        moves_list = list(move_store.iter_moves(game, start_ply=from_ply))
+        ply = from_ply + len(moves_list)
+
+        emit('resync_data', {
+            'game_id': game_id,
+            'from_ply': from_ply,
+            'ply': ply,
+            'moves': moves_list,
+            'turn': 'white' if ply % 2 == 0 else 'black',
+            'status': game.status,
+            'result': game.result,
+            'clocks': remaining_ms(game, datetime.utcnow())
+        })
\ No newline at end of file
@@ -0,0 +1,92 @@
+import logging
+import threading
+
+from . import socketio
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def spectator_room(room):
+    """Return the room holding the sockets watching a game"""
+    return f"{room}_spectators"
+
+
+class SpectatorFeed:
+    """Coalesced, rate-limited position updates for a game's spectators.
+
+    The move handler only records the latest position of its game with
+    ``publish``; a background task emits at most one ``spectator_update``
+    per game every ``interval`` seconds. An update that arrives before the
+    next flush replaces the pending one, so watchers receive the latest
+    position instead of a backlog of moves, and the fan-out to large
+    audiences never runs inside the mover's handler. An interval of 0
+    emits every update immediately.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self.published = 0
+        self.coalesced = 0
+        self.flushed = 0
+
+    def init_app(self, app):
+        """Read the flush interval from the app config"""
+        self.interval = app.config.get('SPECTATOR_FLUSH_INTERVAL', self.interval)
+
+    def publish(self, room, update):
+        """Queue the latest position of a game for its spectators"""
+        if not self.interval:
+            self.published += 1
+            self.flushed += 1
+            socketio.emit('spectator_update', update, to=spectator_room(room))
+            return
+        with self._lock:
+            self.published += 1
+            if room in self._pending:
+                self.coalesced += 1
+            self._pending[room] = update
+            if self._flusher is None:
+                self._flusher = socketio.start_background_task(self._run_flusher)
+
+    def flush(self):
+        """Emit every pending update, returning how many were sent"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for room, update in pending.items():
+            socketio.emit('spectator_update', update, to=spectator_room(room))
+        with self._lock:
+            self.flushed += len(pending)
+        return len(pending)
+
+    def _run_flusher(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error flushing spectator updates")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self):
+        """Return update counters and the number of games awaiting a flush"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'interval': self.interval,
+                'published': self.published,
+                'coalesced': self.coalesced,
+                'flushed': self.flushed
+            }
+
+
+spectator_feed = SpectatorFeed()
+metrics.callback('chess_spectator_updates_total', 'Spectator updates published, coalesced and flushed',
+                 lambda: {event: spectator_feed.stats()[event] for event in ('published', 'coalesced', 'flushed')},
+                 type='counter', label='event')
@@ -0,0 +1,442 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import socketio
+from .clocks import parse_time_control
+from .metrics import metrics
+from .models import db, Game, Tournament, TournamentPlayer
+from .sockets import user_room, clock_scheduler
+
+logger = logging.getLogger(__name__)
+
+SWISS = 'swiss'
+ARENA = 'arena'
+KINDS = (SWISS, ARENA)
+
+# Scores are kept in half-points
+WIN, DRAW = 2, 1
+BYE = WIN
+
+# Bottom half players a top player looks past for one due the other colour
+COLOUR_LOOKAHEAD = 8
+
+PAIRING_SECONDS = metrics.histogram('chess_tournament_pairing_seconds', 'Time spent pairing a tournament round')
+PAIRED_GAMES = metrics.counter('chess_tournament_games_total', 'Tournament games created by the director')
+
+
+class Standing:
+    """A tournament player as the pairing engine sees them"""
+    __slots__ = ('user_id', 'rating', 'score', 'games', 'byes', 'withdrawn',
+                 'whites', 'blacks', 'last_color', 'opponents', 'busy')
+
+    def __init__(self, user_id, rating, score=0, games=0, byes=0, withdrawn=False):
+        self.user_id = user_id
+        self.rating = rating
+        self.score = score
+        self.games = games
+        self.byes = byes
+        self.withdrawn = withdrawn
+        self.whites = 0
+        self.blacks = 0
+        self.last_color = None
+        self.opponents = set()
+        self.busy = False
+
+    def rank_key(self):
+        return (-self.score, -self.rating, self.user_id)
+
+
+def assign_colors(a, b):
+    """Return (white, black) for two paired players.
+
+    White goes to whoever has had it less often, then to whoever had black
+    last, then to the higher ranked player ``a``.
+    """
+    balance_a, balance_b = a.whites - a.blacks, b.whites - b.blacks
+    if balance_a != balance_b:
+        return (a, b) if balance_a < balance_b else (b, a)
+    if a.last_color != b.last_color:
+        return (b, a) if a.last_color == 'white' or b.last_color == 'black' else (a, b)
+    return (a, b)
+
+
+def pair_players(players):
+    """Pair players ranked best first, returning (white, black) pairs and whoever is left over.
+
+    Players are split into score groups. Within a group the top half meets
+    the bottom half, each top player taking the first bottom player they
+    have not met yet, or one of the next few if that one is due the same
+    colour; players left unpaired float down into the next group. Players
+    who have met, or who are both two games over on the same colour so
+    that one would end up three over, are not paired together. Whoever is
+    still unpaired at the end is paired greedily, and a rematch or colour
+    clash that leaves is undone by swapping partners with the nearest pair
+    that allows it; it stays only if none does. A player's ``opponents``
+    holds everyone they must not meet again if avoidable. Runs in
+    O(n * k) for n players and k skipped opponents, plus O(n) per repaired
+    pair, so a thousand players pair in milliseconds.
+    """
+    pairs = []
+    floaters = []
+    for _, group in groupby(players, key=lambda player: player.score):
+        group = floaters + list(group)
+        half = len(group) // 2
+        top, bottom = group[:half], group[half:]
+        floaters = []
+        taken = [False] * len(bottom)
+        first = 0  # Everything before it is taken
+        for player in top:
+            while first < len(bottom) and taken[first]:
+                first += 1
+            choice = _choose_opponent(player, bottom, taken, first)
+            if choice is None:
+                floaters.append(player)
+            else:
+                taken[choice] = True
+                pairs.append(assign_colors(player, bottom[choice]))
+        floaters.extend(opponent for i, opponent in enumerate(bottom) if not taken[i])
+        floaters.sort(key=Standing.rank_key)
+
+    # The last floaters: avoid rematches if possible, otherwise accept them
+    left = []
+    while floaters:
+        player = floaters.pop(0)
+        if not floaters:
+            left.append(player)
+            break
+        choice = _choose_opponent(player, floaters)
+        pairs.append(assign_colors(player, floaters.pop(0 if choice is None else choice)))
+    _repair(pairs)
+    return pairs, left
+
+
+def _colour_due(player):
+    """Return the colour a player should have next, or None if either will do"""
+    balance = player.whites - player.blacks
+    if balance:
+        return 'black' if balance > 0 else 'white'
+    if player.last_color:
+        return 'black' if player.last_color == 'white' else 'white'
+    return None
+
+
+def _colour_clash(a, b):
+    """Return True if whichever colour a and b get, one ends up three games over on it"""
+    balance_a, balance_b = a.whites - a.blacks, b.whites - b.blacks
+    return abs(balance_a) >= 2 and abs(balance_b) >= 2 and (balance_a > 0) == (balance_b > 0)
+
+
+def _acceptable(a, b):
+    """Return True if a and b may be paired: no rematch and no colour clash"""
+    return b.user_id not in a.opponents and not _colour_clash(a, b)
+
+
+def _repair(pairs):
+    """Swap partners between pairs to undo rematches and colour clashes where possible"""
+    for i, (a, b) in enumerate(pairs):
+        if not _acceptable(a, b):
+            _swap_partners(pairs, i)
+
+
+def _swap_partners(pairs, i):
+    """Give the players of pair i the partners of another pair, returning True if one fits"""
+    a, b = pairs[i]
+    # Nearest pairs first, as they are the closest in score
+    for distance in range(1, len(pairs)):
+        for j in (i - distance, i + distance):
+            if not 0 <= j < len(pairs):
+                continue
+            for c, d in (pairs[j], pairs[j][::-1]):
+                if _acceptable(a, c) and _acceptable(b, d):
+                    pairs[i] = assign_colors(*sorted((a, c), key=Standing.rank_key))
+                    pairs[j] = assign_colors(*sorted((b, d), key=Standing.rank_key))
+                    return True
+    return False
+
+
+def _choose_opponent(player, bottom, taken=None, first=0):
+    """Return the index of the bottom half player to pair with player, or None"""
+    due = _colour_due(player)
+    fallback = None
+    looked = 0
+    for i in range(first, len(bottom)):
+        opponent = bottom[i]
+        if (taken and taken[i]) or not _acceptable(player, opponent):
+            continue
+        other = _colour_due(opponent)
+        if due is None or other is None or due != other:
+            return i
+        if fallback is None:
+            fallback = i
+        looked += 1
+        if looked >= COLOUR_LOOKAHEAD:
+            break
+    return fallback
+
+
+def choose_bye(players):
+    """Return the lowest ranked player with the fewest byes, to sit out an odd round"""
+    fewest = min(player.byes for player in players)
+    for player in reversed(players):
+        if player.byes == fewest:
+            return player
+
+
+def load_standings(tournament):
+    """Return {user id: Standing} for a tournament, with scores recounted from its games.
+
+    One query reads the players and one reads every game of the
+    tournament in round order, which also gives each player's colours,
+    past opponents and whether they are playing now. A player who lost a
+    game without making a move, which is how a player who has gone away
+    loses, is withdrawn so they are not paired again until they rejoin.
+    """
+    standings = {}
+    joined = {}
+    for row in db.session.execute(select(
+        TournamentPlayer.user_id, TournamentPlayer.rating, TournamentPlayer.score, TournamentPlayer.games,
+        TournamentPlayer.byes, TournamentPlayer.withdrawn, TournamentPlayer.joined_at
+    ).where(TournamentPlayer.tournament_id == tournament.id)):
+        standings[row.user_id] = Standing(row.user_id, row.rating, row.score, row.games, row.byes, row.withdrawn)
+        joined[row.user_id] = row.joined_at
+    scores = {user_id: standing.byes * BYE for user_id, standing in standings.items()}
+    games = dict.fromkeys(standings, 0)
+    withdrawn = {user_id: standing.withdrawn for user_id, standing in standings.items()}
+    rows = db.session.execute(select(
+        Game.player_white_id, Game.player_black_id, Game.status, Game.result, Game.ply_count, Game.created_at
+    ).where(Game.tournament_id == tournament.id).order_by(Game.round, Game.id))
+    for white_id, black_id, status, result, ply_count, created_at in rows:
+        white, black = standings.get(white_id), standings.get(black_id)
+        if white is None or black is None:
+            continue
+        white.whites += 1
+        black.blacks += 1
+        white.last_color, black.last_color = 'white', 'black'
+        if tournament.kind == ARENA:
+            white.opponents, black.opponents = {black_id}, {white_id}  # Only no immediate rematch
+        else:
+            white.opponents.add(black_id)
+            black.opponents.add(white_id)
+        if status != 'finished':
+            white.busy = black.busy = True
+            continue
+        games[white_id] += 1
+        games[black_id] += 1
+        if result == '1-0':
+            scores[white_id] += WIN
+        elif result == '0-1':
+            scores[black_id] += WIN
+        elif result == '1/2-1/2':
+            scores[white_id] += DRAW
+            scores[black_id] += DRAW
+
+        # White moves on odd plies and black on even ones
+        if result == '0-1' and ply_count == 0:
+            absent = white_id
+        elif result == '1-0' and ply_count <= 1:
+            absent = black_id
+        else:
+            continue
+        if joined[absent] is None or created_at >= joined[absent]:
+            withdrawn[absent] = True
+
+    changed = []
+    for user_id, standing in sorted(standings.items()):
+        current = (scores[user_id], games[user_id], withdrawn[user_id])
+        if (standing.score, standing.games, standing.withdrawn) != current:
+            standing.score, standing.games, standing.withdrawn = current
+            changed.append({'tournament_id': tournament.id, 'user_id': user_id, 'score': standing.score,
+                            'games': standing.games, 'withdrawn': standing.withdrawn})
+    if changed:
+        # In key order, so workers updating the same rows cannot deadlock
+        db.session.execute(update(TournamentPlayer), changed)
+    return standings
+
+
+class TournamentDirector:
+    """Background task that runs every tournament in progress.
+
+    Every ``interval`` seconds it recounts each running tournament's scores
+    from its games and moves it on: a swiss pairs its next round once every
+    game of the current one has finished, an arena pairs whoever is not
+    playing. A round's games are created with one bulk insert and each
+    player is told about their game over their user room. Pairing bumps the
+    tournament's version, so when several workers run the director only one
+    of them commits a given round; the others roll back.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.app = None
+        self._lock = threading.Lock()
+        self._task = None
+        self._resumed = False
+
+    def init_app(self, app):
+        """Read the director's pace from the app config"""
+        self.app = app
+        self.interval = app.config.get('TOURNAMENT_TICK_INTERVAL', self.interval)
+
+    def start(self):
+        """Start the background task, once; called when a tournament starts"""
+        with self._lock:
+            if self._task is None and self.app is not None and self.interval:
+                self._task = socketio.start_background_task(self._run_director)
+
+    def resume(self):
+        """Start the background task if tournaments were running before a restart.
+
+        Called before every request; only the first one in a process looks,
+        so CLI commands and scripts that never serve a request do not.
+        """
+        if self._resumed:
+            return
+        running = db.session.query(Tournament.id).filter(Tournament.status == 'running').first()
+        self._resumed = True
+        if running:
+            self.start()
+
+    def begin(self, tournament, now=None):
+        """Start an open tournament and pair its first round.
+
+        Returns False if it was started concurrently by someone else.
+        """
+        now = now or datetime.utcnow()
+        tournament.status = 'running'
+        tournament.started_at = now
+        if tournament.kind == ARENA:
+            tournament.ends_at = now + timedelta(minutes=tournament.duration_minutes)
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return False
+        self.start()
+        try:
+            self.advance(tournament, now)
+        except StaleDataError:
+            db.session.rollback()  # Another worker paired it first
+        return True
+
+    def advance(self, tournament, now=None):
+        """Update one running tournament's scores and pair or finish it as due.
+
+        Returns the number of games created.
+        """
+        now = now or datetime.utcnow()
+        standings = load_standings(tournament)
+        busy = any(standing.busy for standing in standings.values())
+        active = sorted((standing for standing in standings.values() if not standing.withdrawn),
+                        key=Standing.rank_key)
+
+        if tournament.kind == SWISS:
+            if busy:
+                db.session.commit()
+                return 0
+            if tournament.current_round >= tournament.rounds or len(active) < 2:
+                self.finish(tournament, standings, now)
+                return 0
+            return self.pair_round(tournament, active, now, byes=True)
+
+        if now >= tournament.ends_at:
+            if busy:
+                db.session.commit()
+                return 0
+            self.finish(tournament, standings, now)
+            return 0
+        idle = [standing for standing in active if not standing.busy]
+        if len(idle) < 2:
+            db.session.commit()
+            return 0
+        return self.pair_round(tournament, idle, now, byes=False)
+
+    def pair_round(self, tournament, players, now, byes):
+        """Pair players, create their games in bulk and push the pairings"""
+        with metrics.timed(PAIRING_SECONDS):
+            bye = choose_bye(players) if byes and len(players) % 2 else None
+            pairs, left = pair_players([player for player in players if player is not bye])
+
+        tournament.current_round += 1
+        db.session.flush()  # Claims the round; raises StaleDataError if another worker has it
+
+        base = parse_time_control(tournament.time_control)[0]
+        game_ids = db.session.scalars(insert(Game).returning(Game.id, sort_by_parameter_order=True), [{
+            'player_white_id': white.user_id,
+            'player_black_id': black.user_id,
+            'status': 'active',
+            'time_control': tournament.time_control,
+            'white_clock_ms': base,
+            'black_clock_ms': base,
+            'clock_started_at': now,
+            'tournament_id': tournament.id,
+            'round': tournament.current_round,
+            'created_at': now,
+            'updated_at': now
+        } for white, black in pairs]).all() if pairs else []
+        if bye is not None:
+            db.session.execute(update(TournamentPlayer), [{
+                'tournament_id': tournament.id, 'user_id': bye.user_id,
+                'byes': bye.byes + 1, 'score': bye.score + BYE
+            }])
+        db.session.commit()
+        PAIRED_GAMES.inc(len(game_ids))
+
+        for game_id, (white, black) in zip(game_ids, pairs):
+            clock_scheduler.arm(Game(id=game_id, status='active', ply_count=0, time_control=tournament.time_control,
+                                     white_clock_ms=base, black_clock_ms=base, clock_started_at=now))
+            for player, color, opponent in ((white, 'white', black), (black, 'black', white)):
+                socketio.emit('tournament_pairing', {
+                    'tournament_id': tournament.id,
+                    'round': tournament.current_round,
+                    'game_id': game_id,
+                    'color': color,
+                    'opponent_id': opponent.user_id,
+                    'time_control': tournament.time_control
+                }, to=user_room(player.user_id))
+        if bye is not None:
+            socketio.emit('tournament_bye', {
+                'tournament_id': tournament.id,
+                'round': tournament.current_round
+            }, to=user_room(bye.user_id))
+        logger.debug("Tournament %s round %s: %d games, %d waiting", tournament.id,
+                     tournament.current_round, len(game_ids), len(left))
+        return len(game_ids)
+
+    def finish(self, tournament, standings, now):
+        """Mark a tournament finished and tell its players"""
+        tournament.status = 'finished'
+        tournament.finished_at = now
+        db.session.commit()
+        for user_id in standings:
+            socketio.emit('tournament_finished', {'tournament_id': tournament.id}, to=user_room(user_id))
+
+    def tick(self, now=None):
+        """Advance every running tournament, returning the number of games created"""
+        created = 0
+        for tournament in Tournament.query.filter(Tournament.status == 'running').all():
+            try:
+                created += self.advance(tournament, now)
+            except StaleDataError:
+                db.session.rollback()  # Another worker moved it on first
+            except Exception:
+                db.session.rollback()
+                logger.exception("Error running tournament %s", tournament.id)
+        return created
+
+    def _run_director(self):
+        while True:
+            socketio.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.tick()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Error running tournaments")
+
+
+tournament_director = TournamentDirector()
@@ -0,0 +1,312 @@
+"""Load test and latency benchmark for the HTTP and Socket.IO game paths.
+
+Drives the real create_app() with scripted bots: every game signs up and
+logs in two players, pairs them through /find-game, joins the room over
+Socket.IO and plays make_move until the game ends or hits the ply limit.
+Bots pick random legal moves from the server's legal_moves events, or
+replay games from a PGN file.
+
+Games are interleaved round-robin so all of them are active at once. The
+Flask-SocketIO test client runs handlers inline, so "concurrent" means N
+live games sharing one worker rather than parallel requests.
+
+    python benchmarks/load_test.py --games 50 --plies 60
+    python benchmarks/load_test.py --pgn games.pgn --json results.json
+    python benchmarks/load_test.py --database-url postgresql://localhost/chess_bench
+    python benchmarks/load_test.py --persistence write-behind
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import chess.pgn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Return count and p50/p99/max in milliseconds for samples in seconds"""
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 3) if samples else None,
+        'max_ms': round(max(samples) * 1000, 3) if samples else None
+    }
+
+
+def load_pgn_scripts(path, limit):
+    """Return up to limit games from a PGN file as lists of UCI moves"""
+    scripts = []
+    with open(path) as pgn:
+        while len(scripts) < limit:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            scripts.append([move.uci() for move in game.mainline_moves()])
+    return scripts
+
+
+class Timings:
+    """Latency samples collected during a run, keyed by operation"""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def report(self):
+        return {name: summarize(samples) for name, samples in sorted(self.samples.items())}
+
+
+class BotGame:
+    """Two scripted players sharing one game"""
+
+    def __init__(self, harness, index, script=None):
+        self.harness = harness
+        self.script = script
+        self.rng = random.Random(harness.seed + index)
+        self.ply = 0
+        self.finished = False
+        self.legal_moves = {}
+        prefix = f"bench{harness.run_id}_{index}"
+        self.players = [harness.new_player(f"{prefix}w"), harness.new_player(f"{prefix}b")]
+
+    def start(self):
+        """Pair both players and join the game room"""
+        http_white, http_black = self.players
+        timings = self.harness.timings
+        with timings.measure('http_find_game'):
+            http_white.post('/find-game')
+        with timings.measure('http_find_game'):
+            response = http_black.post('/find-game')
+        self.game_id = response.get_json()['game_id']
+
+        socketio = self.harness.socketio
+        self.sockets = [socketio.test_client(self.harness.app, flask_test_client=client) for client in self.players]
+        for color, sock in enumerate(self.sockets):
+            with timings.measure('socket_join_game'):
+                sock.emit('join_game', {'game_id': self.game_id})
+            self._drain(color)
+
+    def step(self):
+        """Play one move, returning False once the game is over"""
+        if self.finished:
+            return False
+        color = self.ply % 2
+        move = self._choose_move(color)
+        if move is None:
+            self.finished = True
+            return False
+
+        with self.harness.timings.measure('move_ack'):
+            self.sockets[color].emit('make_move', {'game_id': self.game_id, 'move': move})
+        acked = self._drain(color)
+        self._drain(1 - color)
+        if not acked:
+            self.harness.errors += 1
+            self.finished = True
+            return False
+
+        self.ply += 1
+        self.harness.moves += 1
+        if self.ply >= self.harness.max_plies:
+            self.finished = True
+        return not self.finished
+
+    def _choose_move(self, color):
+        if self.script is not None:
+            return self.script[self.ply] if self.ply < len(self.script) else None
+        moves = self.legal_moves.get(color)
+        return self.rng.choice(moves) if moves else None
+
+    def _drain(self, color):
+        """Consume queued events for one player, returning True if a move was acknowledged"""
+        acked = False
+        for packet in self.sockets[color].get_received():
+            data = packet['args'][0] if packet['args'] else {}
+            if packet['name'] == 'game_joined':
+                self.legal_moves[color] = data.get('legal_moves')
+            elif packet['name'] == 'legal_moves':
+                self.legal_moves[color] = data['moves']
+            elif packet['name'] == 'move_made':
+                acked = True
+                if data['status'] == 'finished':
+                    self.finished = True
+        return acked
+
+    def close(self):
+        for sock in self.sockets:
+            sock.disconnect()
+
+
+class Harness:
+    """Owns the app under test and the metrics of one run"""
+
+    def __init__(self, app, socketio, seed, max_plies):
+        self.app = app
+        self.socketio = socketio
+        self.seed = seed
+        self.max_plies = max_plies
+        self.run_id = f"{os.getpid()}{int(time.time() * 1000) % 100000}"
+        self.timings = Timings()
+        self.moves = 0
+        self.errors = 0
+        self._instrument_fanout()
+
+    def _instrument_fanout(self):
+        """Time every move_made broadcast as it fans out to the room"""
+        manager = self.socketio.server.manager
+        emit = manager.emit
+        timings = self.timings
+
+        def timed_emit(event, *args, **kwargs):
+            if event != 'move_made':
+                return emit(event, *args, **kwargs)
+            with timings.measure('broadcast_fanout'):
+                return emit(event, *args, **kwargs)
+
+        manager.emit = timed_emit
+
+    def new_player(self, username):
+        """Sign up and log in a player, returning their HTTP client"""
+        client = self.app.test_client()
+        credentials = {'username': username, 'password': 'benchmark'}
+        with self.timings.measure('http_signup'):
+            client.post('/signup', json={**credentials, 'email': f"{username}@bench.invalid"})
+        with self.timings.measure('http_login'):
+            client.post('/login', json=credentials)
+        return client
+
+    def play(self, games):
+        """Interleave moves across all games until every one has finished"""
+        active = list(games)
+        start = time.perf_counter()
+        while active:
+            active = [game for game in active if game.step()]
+        return time.perf_counter() - start
+
+
+def make_games(harness, count, scripts, offset=0):
+    games = []
+    for index in range(count):
+        script = scripts[index % len(scripts)] if scripts else None
+        game = BotGame(harness, offset + index, script)
+        game.start()
+        games.append(game)
+    return games
+
+
+def run(args):
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    # The Socket.IO test client needs an in-process server without a queue
+    os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    os.environ['MATCHMAKING_SWEEP_INTERVAL'] = '0'
+    os.environ['PERSISTENCE_MODE'] = args.persistence
+    os.environ.setdefault('JOURNAL_PATH', os.path.join(tempfile.mkdtemp(), 'journal'))
+
+    from app import create_app, socketio
+    from app.persistence import move_store
+    from app.sockets import board_cache
+
+    app = create_app()
+    app.config['TESTING'] = True
+    harness = Harness(app, socketio, args.seed, args.plies)
+    scripts = load_pgn_scripts(args.pgn, args.games) if args.pgn else None
+
+    # Keep anything the app writes to stdout off the report
+    quiet = contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+    with quiet:
+        games = make_games(harness, args.games, scripts)
+        elapsed = harness.play(games)
+        # Background tasks do not run under the test client, so commit the
+        # write-behind queue here and report it separately
+        with app.app_context(), harness.timings.measure('final_group_commit'):
+            move_store.flush()
+        moves, errors = harness.moves, harness.errors
+        latency = harness.timings.report()
+        for game in games:
+            game.close()
+
+        # Memory is traced in a separate pass so tracing does not skew latency
+        memory_games = min(args.games, args.memory_games)
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        traced = make_games(harness, memory_games, scripts, offset=args.games)
+        for game in traced:
+            for _ in range(min(args.plies, 20)):
+                if not game.step():
+                    break
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for game in traced:
+            game.close()
+
+    grown = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {
+        'config': {
+            'games': args.games,
+            'max_plies': args.plies,
+            'pgn': args.pgn,
+            'seed': args.seed,
+            'persistence': args.persistence,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split('://')[0]
+        },
+        'moves': moves,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'moves_per_s': round(moves / elapsed, 1) if elapsed else None,
+        'latency': latency,
+        'memory_per_game_bytes': grown // memory_games if memory_games else None,
+        'board_cache': board_cache.stats()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=20, help='Concurrent games to simulate')
+    parser.add_argument('--plies', type=int, default=60, help='Maximum plies per game')
+    parser.add_argument('--pgn', help='Replay games from this PGN file instead of random moves')
+    parser.add_argument('--database-url', help='Database to run against (default: temporary SQLite file)')
+    parser.add_argument('--persistence', choices=('sync', 'write-behind'), default='sync',
+                        help='Commit every move, or journal moves and commit them in batches')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for bot moves')
+    parser.add_argument('--memory-games', type=int, default=10, help='Games to trace for memory per game')
+    parser.add_argument('--json', help='Also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show server log output')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
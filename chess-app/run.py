@@ -1,4 +1,16 @@
 import os
+
+# Eventlet needs the standard library patched before anything else is
+# imported, so locks and sockets cooperate with the hub. Only the
+# development server patches here: gunicorn's eventlet worker patches on
+# its own, and commands run through the Flask CLI must not be patched
+if __name__ == '__main__' and os.environ.get('EVENTLET_MONKEY_PATCH', 'True').lower() == 'true':
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+    except ImportError:
+        pass
+
 from app import create_app, socketio
 
 app = create_app()
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from app import create_app, socketio
+from app.models import db, Game, User
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """An app on a throwaway SQLite database, with password hashing inline"""
+    path = tmp_path_factory.mktemp('db') / 'chess.db'
+    os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+    os.environ.setdefault('AUTH_HASH_WORKERS', '0')
+    app = create_app()
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+        db.session.rollback()
+
+
+@pytest.fixture(scope='session')
+def players(app):
+    """Ids of two people to play games between"""
+    with app.app_context():
+        users = [User(username=f'player{i}', email=f'player{i}@example.com', password_hash='x') for i in (1, 2)]
+        db.session.add_all(users)
+        db.session.commit()
+        return [user.id for user in users]
+
+
+@pytest.fixture
+def game(app_context, players):
+    """An active untimed game with no moves"""
+    game = Game(player_white_id=players[0], player_black_id=players[1], status='active')
+    db.session.add(game)
+    db.session.commit()
+    return game
+
+
+@pytest.fixture
+def login(app):
+    """Return a test client logged in as the given user"""
+    def login(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+        return client
+    return login
+
+
+@pytest.fixture
+def connect(app, login):
+    """Return a socket client connected as the given user, disconnected after the test"""
+    clients = []
+
+    def connect(user_id):
+        client = socketio.test_client(app, flask_test_client=login(user_id))
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        if client.is_connected():
+            client.disconnect()
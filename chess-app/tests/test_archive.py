@@ -0,0 +1,86 @@
+import io
+from datetime import datetime, timedelta
+
+import chess.pgn
+import pytest
+
+from app.archive import archive_batch
+from app.models import db, ArchivedGame, Game, GameMove, GameSnapshot, pack_moves, unpack_moves
+from app.persistence import move_store
+from app.snapshots import save_snapshot
+
+# En passant, castling on both sides and promotions to a knight and a rook
+GAME = ('e2e4 d7d5 e4e5 f7f5 e5f6 g8h6 f6g7 b8c6 g7h8n c8e6 g1f3 d8d7 f1e2 e8c8 e1g1 '
+        'a7a5 b2b4 a5b4 a2a3 b4a3 c2c3 a3a2 d2d4 a2b1r').split()
+
+
+@pytest.mark.parametrize('uci_moves', [
+    [],
+    GAME,
+    ['a7a8q', 'b2a1b', 'h7g8r', 'c2c1n', 'e1c1', 'e8g8', 'd5e6', 'h1h8'],
+    [move.uci() for move in chess.Board().legal_moves] * 50,
+])
+def test_packed_moves_round_trip(uci_moves):
+    assert unpack_moves(pack_moves(uci_moves)) == uci_moves
+
+
+@pytest.mark.parametrize('move_uci', ['0000', 'e2e9', 'e7e8k'])
+def test_moves_that_cannot_be_packed_are_rejected(move_uci):
+    with pytest.raises(ValueError):
+        pack_moves(['e2e4', move_uci])
+
+
+def exported(client, game_id):
+    """Return the PGN export of one of the user's games, as python-chess prints it"""
+    pgn = io.StringIO(client.get('/my-games/export.pgn').get_data(as_text=True))
+    games = []
+    while (game := chess.pgn.read_game(pgn)) is not None:
+        if game.headers['Site'] == f'Game {game_id}':
+            games.append(str(game))
+    assert len(games) == 1
+    return games[0]
+
+
+def history_entry(client, game_id):
+    entries = [game for game in client.get('/my-games', query_string={'limit': 100}).json['games']
+               if game['id'] == game_id]
+    assert len(entries) == 1
+    return entries[0]
+
+
+def test_archived_games_read_as_before(app_context, game, login):
+    board = chess.Board()
+    for ply, move_uci in enumerate(GAME, start=1):
+        board.push_uci(move_uci)
+        game.add_move(move_uci)
+        if ply == 20:
+            save_snapshot(game, board)
+    ended = datetime.utcnow() - timedelta(days=60)
+    game.status, game.result, game.explored, game.updated_at = 'finished', '0-1', True, ended
+    db.session.commit()
+    game_id, white_id = game.id, game.player_white_id
+
+    client = login(white_id)
+    before = exported(client, game_id), history_entry(client, game_id)
+
+    archived = archive_batch(datetime.utcnow() - timedelta(days=30), 1000)[0]
+    assert archived >= 1
+    db.session.expire_all()
+    assert db.session.get(Game, game_id) is None
+    assert GameMove.query.filter_by(game_id=game_id).count() == 0
+    assert db.session.get(GameSnapshot, game_id) is None
+    assert ArchivedGame.query.filter_by(id=game_id).one().ply_count == len(GAME)
+
+    assert (exported(client, game_id), history_entry(client, game_id)) == before
+    pgn_game = chess.pgn.read_game(io.StringIO(before[0]))
+    assert [move.uci() for move in pgn_game.mainline_moves()] == GAME
+
+    loaded = move_store.load_game(game_id)
+    assert list(move_store.iter_moves(loaded)) == GAME
+    page = client.get(f'/game/{game_id}')
+    assert page.status_code == 200
+    assert ' '.join(GAME) in page.get_data(as_text=True)
+
+    # A second pass finds nothing more to do for it
+    archive_batch(datetime.utcnow() - timedelta(days=30), 1000)
+    assert ArchivedGame.query.filter_by(id=game_id).count() == 1
@@ -0,0 +1,154 @@
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+import chess
+import pytest
+
+from app.models import db, Game, GameMove
+from app.persistence import MoveJournal, MoveStore, write_records
+
+
+@pytest.fixture
+def make_store(app, tmp_path, monkeypatch):
+    """Build write-behind stores sharing one journal, as successive runs of a worker would"""
+    monkeypatch.setitem(app.config, 'PERSISTENCE_MODE', 'write-behind')
+    monkeypatch.setitem(app.config, 'JOURNAL_PATH', str(tmp_path / 'journal'))
+    monkeypatch.setitem(app.config, 'WRITE_BEHIND_INTERVAL', 3600)  # Tests flush by hand
+    stores = []
+
+    def make_store():
+        for previous in stores:
+            previous.journal.close()  # The previous run is gone, as if it crashed
+        store = MoveStore()
+        store.init_app(app)
+        stores.append(store)
+        return store
+
+    yield make_store
+    for store in stores:
+        store.journal.close()
+
+
+def play(store, game_id, *moves):
+    game = store.load_game(game_id)
+    board = store.load_board(game)
+    for move_uci in moves:
+        board.push_uci(move_uci)
+        store.persist_move(game, board, move_uci, datetime.utcnow())
+    return game
+
+
+def journal_records(store):
+    return [record for path in store.journal.segments() for record in MoveJournal.read(path)]
+
+
+def committed_moves(game_id):
+    db.session.expire_all()
+    return [move.uci for move in GameMove.query.filter_by(game_id=game_id).order_by(GameMove.ply)]
+
+
+def test_replaying_committed_records_changes_nothing(make_store, game):
+    store = make_store()
+    play(store, game.id, 'e2e4')
+    segment = store.journal.segments()[-1]
+    with open(segment) as f:
+        journaled = f.read()
+    assert store.flush() == 1
+    assert not os.path.exists(segment)
+    play(store, game.id, 'e7e5')
+    assert store.flush() == 1
+
+    # As if the worker died after committing the first move but before deleting its segment
+    with open(segment, 'w') as f:
+        f.write(journaled)
+    restarted = make_store()
+    assert restarted.replay() == 1
+    assert committed_moves(game.id) == ['e2e4', 'e7e5']
+    assert db.session.get(Game, game.id).ply_count == 2
+    assert restarted.journal.segments() == []
+
+
+def test_replay_ignores_torn_last_line(make_store, game):
+    store = make_store()
+    play(store, game.id, 'e2e4', 'e7e5')
+    with open(store.journal.segments()[-1], 'a') as f:
+        f.write('{"game_id":%d,"ply":3,"mo' % game.id)
+
+    restarted = make_store()
+    assert restarted.replay() == 2
+    assert committed_moves(game.id) == ['e2e4', 'e7e5']
+    assert db.session.get(Game, game.id).ply_count == 2
+
+
+def test_replay_recovers_moves_journaled_before_a_crash(make_store, game):
+    store = make_store()
+    play(store, game.id, 'e2e4', 'c7c5')
+    assert committed_moves(game.id) == []  # Acknowledged, but the group commit never ran
+
+    restarted = make_store()
+    assert restarted.replay() == 2
+    assert committed_moves(game.id) == ['e2e4', 'c7c5']
+    board = restarted.load_board(restarted.load_game(game.id))
+    assert board.move_stack == [chess.Move.from_uci('e2e4'), chess.Move.from_uci('c7c5')]
+
+
+def test_stale_records_are_rejected(make_store, game):
+    store = make_store()
+    play(store, game.id, 'e2e4')
+    record, = journal_records(store)
+    store.flush()
+
+    write_records([
+        dict(record, move='d2d4'),  # Another move for a ply already committed
+        dict(record, ply=3, move='g1f3'),  # A gap in the game's moves
+        dict(record, ply=0, move=None, status='finished', result='1-0'),  # A game update from before the move
+    ])
+    assert committed_moves(game.id) == ['e2e4']
+    game = db.session.get(Game, game.id)
+    assert (game.ply_count, game.status, game.result) == (1, 'active', None)
+
+
+def test_workers_cannot_share_a_journal(app, make_store, game):
+    store = make_store()
+    assert store.replay() == 0
+    play(store, game.id, 'e2e4')
+    segment, = store.journal.segments()
+
+    other = MoveStore()
+    other.init_app(app)
+    with pytest.raises(RuntimeError, match='JOURNAL_PATH'):
+        other.replay()
+    with pytest.raises(RuntimeError, match='JOURNAL_PATH'):
+        play(other, game.id, 'd2d4')
+    assert other.journal.segments() == [segment]
+    assert committed_moves(game.id) == []
+
+    # Once the first worker is gone, the journal can be taken over and replayed
+    store.journal.close()
+    assert other.replay() == 1
+    assert committed_moves(game.id) == ['e2e4']
+    other.journal.close()
+
+
+def idle(started):
+    started.set()
+    time.sleep(30)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+def test_forked_children_do_not_hold_the_journal_lock(app, make_store):
+    store = make_store()
+    store.replay()
+    context = multiprocessing.get_context('fork')
+    started = context.Event()
+    child = context.Process(target=idle, args=(started,))
+    child.start()
+    try:
+        assert started.wait(10)
+        store.journal.close()  # The worker dies; its pool processes live on
+        assert make_store().replay() == 0
+    finally:
+        child.kill()
+        child.join()
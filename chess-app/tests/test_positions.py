@@ -0,0 +1,113 @@
+import chess
+import pytest
+
+from app.models import db
+from app.persistence import move_store
+from app.positions import (FIFTY_MOVES, FIVEFOLD_REPETITION, SEVENTYFIVE_MOVES, THREEFOLD_REPETITION,
+                           PositionTracker)
+from app.snapshots import load_board, save_snapshot
+from app.sockets import board_cache
+
+# Knights out and back, which repeats the position every four plies
+SHUFFLE = ['g1f3', 'g8f6', 'f3g1', 'f6g8'] * 4
+
+
+def board_repetitions(board):
+    """How often python-chess counts the current position, walking the move stack"""
+    return next(count for count in range(1, 10) if not board.is_repetition(count + 1))
+
+
+def status(tracker, board):
+    legal_moves = [move.uci() for move in board.legal_moves]
+    return tracker.outcome(board, legal_moves, board.is_check()), tracker.claimable_draw(board)
+
+
+def test_threefold_repetition_is_claimable_and_fivefold_ends_the_game():
+    board = chess.Board()
+    tracker = PositionTracker(board)
+    for ply, move_uci in enumerate(SHUFFLE, start=1):
+        board.push_uci(move_uci)
+        tracker.push(board)
+        assert tracker.repetitions() == board_repetitions(board) == 1 + ply // 4
+        outcome, claim = status(tracker, board)
+        assert (claim == THREEFOLD_REPETITION) == board.is_repetition(3)
+        assert (outcome == ('1/2-1/2', FIVEFOLD_REPETITION)) == board.is_fivefold_repetition()
+    assert board.is_fivefold_repetition()
+
+
+def test_pawn_moves_and_captures_start_the_count_over():
+    board = chess.Board()
+    tracker = PositionTracker(board)
+    for move_uci in SHUFFLE[:8] + ['e2e4', 'g8f6', 'g1f3', 'f6g8', 'f3g1']:
+        board.push_uci(move_uci)
+        tracker.push(board)
+    assert tracker.repetitions() == board_repetitions(board) == 2
+    assert tracker.claimable_draw(board) is None
+
+
+@pytest.mark.parametrize('halfmove_clock, outcome, claim', [
+    (98, None, None),
+    (99, None, FIFTY_MOVES),
+    (149, ('1/2-1/2', SEVENTYFIVE_MOVES), FIFTY_MOVES),
+])
+def test_fifty_and_seventyfive_move_rules(halfmove_clock, outcome, claim):
+    board = chess.Board(f'4k3/8/8/8/8/8/4P3/4K2R w - - {halfmove_clock} 80')
+    tracker = PositionTracker(board)
+    board.push_uci('h1h2')
+    tracker.push(board)
+    assert status(tracker, board) == (outcome, claim)
+
+
+@pytest.mark.parametrize('snapshot_ply', range(3, 19))
+def test_repetitions_survive_a_snapshot_rebuild(app_context, game, snapshot_ply):
+    board = chess.Board()
+    for ply, move_uci in enumerate(['e2e4', 'e7e5'] + SHUFFLE, start=1):
+        board.push_uci(move_uci)
+        game.add_move(move_uci)
+        if ply == snapshot_ply:
+            save_snapshot(game, board)
+        db.session.commit()
+
+        rebuilt = load_board(game)
+        assert rebuilt.fen() == board.fen()
+        tracker = PositionTracker(rebuilt)
+        assert tracker.repetitions() == board_repetitions(board)
+        assert status(tracker, rebuilt) == status(PositionTracker(board), board)
+
+
+def play_rebuilding(clients, game_id, moves):
+    """Play moves over the players' sockets, rebuilding the board from its snapshot before each one"""
+    for ply, move_uci in enumerate(moves):
+        board_cache.discard(f'game_{game_id}')
+        client = clients[ply % 2]
+        client.emit('make_move', {'game_id': game_id, 'move': move_uci})
+        assert not [message for message in client.get_received() if message['name'] == 'error']
+
+
+@pytest.fixture
+def sides(connect, game, players, monkeypatch):
+    """Sockets of the white and black players, with a snapshot every three plies"""
+    monkeypatch.setattr(move_store, 'snapshot_interval', 3)
+    return [connect(user_id) for user_id in players]
+
+
+def test_threefold_repetition_can_be_claimed_across_snapshot_rebuilds(game, sides):
+    play_rebuilding(sides, game.id, ['e2e4', 'e7e5'] + SHUFFLE[:7])
+    sides[1].emit('claim_draw', {'game_id': game.id})
+    assert [message['args'][0]['message'] for message in sides[1].get_received()] == [
+        'No draw can be claimed in this position.']
+
+    play_rebuilding(sides[::-1], game.id, SHUFFLE[7:8])
+    board_cache.discard(f'game_{game.id}')
+    sides[0].emit('claim_draw', {'game_id': game.id})
+    db.session.expire_all()
+    assert (game.status, game.result) == ('finished', '1/2-1/2')
+
+
+def test_fivefold_repetition_ends_the_game_across_snapshot_rebuilds(game, sides):
+    play_rebuilding(sides, game.id, ['e2e4', 'e7e5'] + SHUFFLE[:15])
+    db.session.expire_all()
+    assert game.status == 'active'
+    play_rebuilding(sides[::-1], game.id, SHUFFLE[15:])
+    db.session.expire_all()
+    assert (game.status, game.result, game.ply_count) == ('finished', '1/2-1/2', 18)
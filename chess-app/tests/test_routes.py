@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app.models import db, Game, User
+
+
+def make_history(prefix):
+    """Create a user with games as both colours, some updated at the same time; return (id, game ids newest first)"""
+    users = [User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com', password_hash='x') for i in range(3)]
+    db.session.add_all(users)
+    db.session.flush()
+    me, first, second = (user.id for user in users)
+    start = datetime(2026, 1, 1)
+    games = []
+    for i in range(9):
+        opponent = (first, second)[i % 2]
+        white, black = (me, opponent) if i % 3 else (opponent, me)
+        games.append(Game(player_white_id=white, player_black_id=black, status='finished', result='1-0',
+                          updated_at=start + timedelta(minutes=i // 2)))
+    db.session.add_all(games)
+    db.session.add(Game(player_white_id=first, player_black_id=second, status='finished'))
+    db.session.commit()
+    return me, [game.id for game in sorted(games, key=lambda game: (game.updated_at, game.id), reverse=True)]
+
+
+def test_my_games_pages_through_games_as_either_colour(login, app_context):
+    me, expected = make_history('history')
+    client = login(me)
+    seen, query = [], {'limit': 2}
+    while True:
+        page = client.get('/my-games', query_string=query).json
+        seen.extend(game['id'] for game in page['games'])
+        if not page['next_cursor']:
+            break
+        query['cursor'] = page['next_cursor']
+    assert seen == expected
+
+
+def test_my_games_reads_each_colour_through_its_index(login, app_context):
+    me, _ = make_history('planned')
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM games' in statement or 'FROM archived_games' in statement:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        client = login(me)
+        first = client.get('/my-games', query_string={'limit': 1}).json
+        client.get('/my-games', query_string={'limit': 1, 'cursor': first['next_cursor']})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+    # No query may read all of the user's games to sort them
+    assert len(statements) == 8
+    for statement, parameters in statements:
+        plan = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+        assert not any('TEMP B-TREE' in row[-1] or 'MULTI-INDEX' in row[-1] for row in plan), plan
@@ -0,0 +1,23 @@
+import chess
+
+from app.models import db
+from app.sockets import board_cache
+from app.snapshots import save_snapshot
+
+
+def test_legal_moves_report_the_game_ply_after_a_snapshot_rebuild(connect, game, players):
+    board = chess.Board()
+    for ply, move_uci in enumerate(['e2e4', 'd7d5', 'e4d5', 'd8d5', 'b1c3'], start=1):
+        board.push_uci(move_uci)
+        game.add_move(move_uci)
+        if ply == 4:
+            save_snapshot(game, board)  # Right after a capture, so it stores no history
+    db.session.commit()
+    board_cache.discard(f'game_{game.id}')
+
+    client = connect(players[1])
+    client.emit('get_legal_moves', {'game_id': game.id})
+    legal_moves, = [message['args'][0] for message in client.get_received() if message['name'] == 'legal_moves']
+    assert legal_moves['ply'] == 5
+    assert sorted(legal_moves['moves']) == sorted(move.uci() for move in board.legal_moves)
+
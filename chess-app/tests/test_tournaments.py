@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+from app.models import db, Game, Tournament, TournamentPlayer, User
+from app.tournaments import ARENA, DRAW, WIN, BYE, Standing, choose_bye, pair_players, tournament_director
+
+
+def play_round(players, rng):
+    """Pair one swiss round the way the director does and play out its games"""
+    order = sorted((player for player in players if not player.withdrawn), key=Standing.rank_key)
+    bye = choose_bye(order) if len(order) % 2 else None
+    pairs, left = pair_players([player for player in order if player is not bye])
+    if bye is not None:
+        bye.byes += 1
+        bye.score += BYE
+    for white, black in pairs:
+        white.whites += 1
+        black.blacks += 1
+        white.last_color, black.last_color = 'white', 'black'
+        r = rng.random() + (white.rating - black.rating) / 2000
+        if r > 0.65:
+            white.score += WIN
+        elif r < 0.35:
+            black.score += WIN
+        else:
+            white.score += DRAW
+            black.score += DRAW
+    return order, bye, pairs, left
+
+
+@pytest.mark.parametrize('size', [2, 7, 24, 57, 120, 1001])
+@pytest.mark.parametrize('seed', range(5))
+def test_swiss_simulation(size, seed):
+    rng = random.Random(seed)
+    players = [Standing(user_id, rng.randint(800, 2400)) for user_id in range(1, size + 1)]
+    rounds = min(11, size // 2)  # Few enough rounds that a rematch can always be avoided
+
+    for _ in range(rounds):
+        met = {player.user_id: set(player.opponents) for player in players}
+        fewest_byes = min(player.byes for player in players)
+        due_bye = [player for player in sorted(players, key=Standing.rank_key) if player.byes == fewest_byes]
+        order, bye, pairs, left = play_round(players, rng)
+
+        # Everyone plays once, or sits out with the bye
+        assert not left
+        seated = [player.user_id for pair in pairs for player in pair] + ([bye.user_id] if bye else [])
+        assert sorted(seated) == [player.user_id for player in sorted(players, key=lambda p: p.user_id)]
+
+        # The bye goes to the lowest ranked of those with the fewest byes
+        assert bye is (due_bye[-1] if size % 2 else None)
+
+        for white, black in pairs:
+            assert black.user_id not in met[white.user_id]
+            white.opponents.add(black.user_id)
+            black.opponents.add(white.user_id)
+        assert max(abs(player.whites - player.blacks) for player in players) <= 2
+
+
+def test_unavoidable_rematches_are_paired():
+    rng = random.Random(0)
+    players = [Standing(user_id, 1500) for user_id in range(1, 5)]
+    for _ in range(5):
+        order, bye, pairs, left = play_round(players, rng)
+        assert bye is None and not left and len(pairs) == 2
+        for white, black in pairs:
+            white.opponents.add(black.user_id)
+            black.opponents.add(white.user_id)
+    assert max(abs(player.whites - player.blacks) for player in players) <= 2
+
+
+def test_players_who_lose_without_moving_are_withdrawn(app, app_context, monkeypatch):
+    monkeypatch.setattr(tournament_director, 'interval', 0)  # Ticked by hand
+    users = [User(username=f'arena{i}', email=f'arena{i}@example.com', password_hash='x') for i in range(4)]
+    db.session.add_all(users)
+    db.session.flush()
+    tournament = Tournament(name='Arena', kind=ARENA, time_control='1+0', duration_minutes=60,
+                            created_by=users[0].id)
+    db.session.add(tournament)
+    db.session.flush()
+    db.session.add_all(TournamentPlayer(tournament_id=tournament.id, user_id=user.id, rating=1500) for user in users)
+    db.session.commit()
+    assert tournament_director.begin(tournament)
+
+    def active_games():
+        db.session.expire_all()
+        return Game.query.filter_by(tournament_id=tournament.id, status='active').order_by(Game.id).all()
+
+    def withdrawn():
+        db.session.expire_all()
+        return {player.user_id for player in TournamentPlayer.query.filter_by(
+            tournament_id=tournament.id, withdrawn=True)}
+
+    # White's flag falls before their first move; black's after white's first move
+    first, second = active_games()
+    first.status, first.result = 'finished', '0-1'
+    second.status, second.result, second.ply_count = 'finished', '1-0', 1
+    db.session.commit()
+    gone = {first.player_white_id, second.player_black_id}
+
+    assert tournament_director.tick() == 1
+    assert withdrawn() == gone
+    game, = active_games()
+    assert {game.player_white_id, game.player_black_id}.isdisjoint(gone)
+
+    # Rejoining puts them back, and the games they missed no longer count
+    for user_id in gone:
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+        assert client.post(f'/tournaments/{tournament.id}/join').status_code == 200
+    assert tournament_director.tick() == 1
+    assert withdrawn() == set()
+    assert {player for game in active_games()[1:] for player in (game.player_white_id, game.player_black_id)} == gone